@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+import database as db
+import metrics
+from config import BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP
+
+PREFIX = "bot-"
+
+
+class BackupJob:
+    """Периодические онлайн-копии базы (см. Storage.backup) с ротацией старых файлов."""
+
+    def __init__(self, directory: str = BACKUP_DIR, interval: float = BACKUP_INTERVAL, keep: int = BACKUP_KEEP):
+        self.directory = directory
+        self.interval = interval * 3600
+        self.keep = keep
+        self.last_finished = 0.0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def run(self):
+        """Делает копию сейчас; возвращает (путь, размер в байтах, секунды)."""
+        async with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{PREFIX}{datetime.datetime.now():%Y%m%d-%H%M%S}.db")
+            # Недописанная копия не должна выглядеть готовой: имя меняется только в конце
+            partial = path + ".part"
+            started = time.perf_counter()
+            try:
+                await db.storage.backup(partial)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            os.replace(partial, path)
+            elapsed = time.perf_counter() - started
+            self.last_finished = time.time()
+            self._prune()
+            logging.info("Database backup %s written in %.1f s", path, elapsed)
+            return path, os.path.getsize(path), elapsed
+
+    def _prune(self):
+        backups = sorted(name for name in os.listdir(self.directory)
+                         if name.startswith(PREFIX) and name.endswith(".db"))
+        for name in backups[:-self.keep] if self.keep else ():
+            os.remove(os.path.join(self.directory, name))
+
+    def launch(self, on_done):
+        """Копия по запросу админа фоном; on_done(текст) получает итог."""
+
+        async def job():
+            try:
+                path, size, elapsed = await self.run()
+            except Exception as e:
+                logging.exception("Database backup failed")
+                on_done(f"❌ Копия базы не создана: {e}")
+            else:
+                on_done(f"✅ Копия базы: {path} ({size / 2 ** 20:.1f} МБ за {elapsed:.1f} с)")
+
+        asyncio.create_task(job())
+
+    def start(self):
+        if self.interval and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Начатая копия дописывается до конца, а не бросается на полпути
+        async with self._lock:
+            pass
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except Exception:
+                logging.exception("Database backup failed")
+
+
+backups = BackupJob()
+metrics.registry.collect("db_backup_last_timestamp", lambda: backups.last_finished)
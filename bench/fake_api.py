@@ -0,0 +1,99 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+CHANNEL_ID = -1001234567890
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отвечает на методы, которые вызывает бот, с задержкой и случайными 429."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, member_rate: float = 0.8):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.member_rate = member_rate
+        self.calls = Counter()
+        self.errors = 0
+        self.updates = asyncio.Queue()
+        self._message_id = 0
+        self._update_id = 0
+
+    def push_update(self, update: dict):
+        """Кладёт обновление в очередь getUpdates (update_id проставляется автоматически)."""
+        self._update_id += 1
+        self.updates.put_nowait({**update, "update_id": self._update_id})
+
+    def _message(self, chat_id, text=None) -> dict:
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}, "from": BOT_USER}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    async def _get_updates(self, params) -> list:
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        limit = int(params.get("limit") or 100)
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def _result(self, method: str, params):
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params.get("chat_id", 0), params.get("text", ""))
+        if method == "getChat":
+            # ChatFullInfo: без accent_color_id и max_reaction_count aiogram не разберёт ответ
+            return {"id": CHANNEL_ID, "type": "channel", "title": "Bench channel",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+        if method == "getChatMember":
+            status = "member" if random.random() < self.member_rate else "left"
+            user = {"id": int(params["user_id"]), "is_bot": False, "first_name": "user"}
+            return {"status": status, "user": user}
+        # answerCallbackQuery, deleteMessage, deleteWebhook, setWebhook и прочее
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if method != "getUpdates":
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                })
+        return web.json_response({"ok": True, "result": await self._result(method, params)},
+                                 dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+async def serve(fake: FakeTelegram, host: str = "127.0.0.1", port: int = 0):
+    """Запускает заглушку и возвращает (runner, базовый URL для TelegramAPIServer)."""
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
@@ -0,0 +1,225 @@
+"""Нагрузочный прогон бота без Telegram.
+
+    python -m bench.run --updates 2000 --concurrency 200 --latency 20 --error-rate 0.01
+
+Поднимает заглушку Bot API (bench/fake_api.py), подключает к ней настоящие роутеры
+из bot.py и гоняет синтетический трафик: волну /start по реферальным ссылкам,
+спам профиля, нажатия «Проверить подписку», одобрение заявок админом
+и флуд одной кнопкой от нескольких пользователей.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import database as db
+from bench.fake_api import FakeTelegram, serve
+from bot import create_dispatcher
+from config import ADMIN_ID, WEBHOOK_CONCURRENCY
+import metrics
+import priority
+from notifier import notifier
+
+SCENARIOS = ("viral", "profile", "check_sub", "admin", "flood")
+FLOODERS = 10
+SEED_USERS = 1000
+REFERRERS = 100
+NEW_USER_BASE = 10_000_000
+
+
+class Recorder:
+    """Внешний middleware: время обработки каждого обновления по сценариям
+    (в режиме feed — от поступления, включая ожидание в очереди перед диспетчером)."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.labels = {}
+        self.arrived = {}
+        self.latencies = defaultdict(list)
+        self.processed = 0
+        self.errors = 0
+        self.done = asyncio.Event()
+
+    async def __call__(self, handler, event, data):
+        started = self.arrived.pop(event.update_id, None) or time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            label = self.labels.get(event.update_id, "other")
+            self.latencies[label].append(time.perf_counter() - started)
+            self.processed += 1
+            if self.processed >= self.expected:
+                self.done.set()
+
+
+def user(user_id: int, username: bool = True) -> dict:
+    result = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    if username:
+        result["username"] = f"user{user_id}"
+    return result
+
+
+def message(user_id: int, text: str) -> dict:
+    return {"message": {"message_id": 1, "date": int(time.time()), "text": text,
+                        "chat": {"id": user_id, "type": "private"}, "from": user(user_id)}}
+
+
+def callback(user_id: int, data: str) -> dict:
+    return {"callback_query": {
+        "id": f"{user_id}-{random.getrandbits(32)}", "chat_instance": "bench", "data": data,
+        "from": user(user_id),
+        "message": {"message_id": 1, "date": int(time.time()), "text": "…",
+                    "chat": {"id": user_id, "type": "private"}},
+    }}
+
+
+def generate(scenarios, count: int, withdrawal_ids) -> list:
+    updates = []
+    for scenario in scenarios:
+        for i in range(count):
+            if scenario == "viral":
+                update = message(NEW_USER_BASE + i, f"/start {random.randint(1, REFERRERS)}")
+            elif scenario == "profile":
+                update = message(random.randint(1, SEED_USERS), "👤 Мой профиль")
+            elif scenario == "flood":
+                # Несколько пользователей долбят одну кнопку — их должен срезать антифлуд
+                update = message(random.randint(1, FLOODERS), "👤 Мой профиль")
+            elif scenario == "check_sub":
+                update = callback(random.randint(REFERRERS + 1, SEED_USERS), "check_sub")
+            else:
+                if not withdrawal_ids:
+                    break
+                update = callback(ADMIN_ID, f"approve_{withdrawal_ids.pop()}")
+            updates.append((scenario, update))
+    random.shuffle(updates)
+    return updates
+
+
+async def seed(scenarios, count: int):
+    # Параллельные записи уходят пачками через групповой коммит
+    await asyncio.gather(*(
+        db.add_user(user_id, f"user{user_id}", random.randint(1, REFERRERS) if user_id > REFERRERS else None)
+        for user_id in range(1, SEED_USERS + 1)
+    ))
+    withdrawal_ids = []
+    if "admin" in scenarios:
+        user_ids = [random.randint(1, SEED_USERS) for _ in range(count)]
+        await asyncio.gather(*(db.adjust_balance(user_id, 600 * db.KOPECKS) for user_id in user_ids))
+        await asyncio.gather(*(db.add_withdrawal(user_id, 600) for user_id in user_ids))
+        withdrawal_ids = [row[0] for row in await db.storage.fetchall("SELECT id FROM withdrawals")]
+    if "check_sub" in scenarios:
+        await db.update_settings("bench_channel", True)
+    return withdrawal_ids
+
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+def report(recorder: Recorder, elapsed: float, fake: FakeTelegram, commits: int, writer_time: float,
+           reader_time: float):
+    all_latencies = [v for values in recorder.latencies.values() for v in values]
+    print(f"\nОбработано обновлений: {recorder.processed} за {elapsed:.2f} с "
+          f"— {recorder.processed / elapsed:.0f} upd/s, с ошибкой: {recorder.errors}")
+    print(f"{'сценарий':<12}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for label, values in sorted(recorder.latencies.items()) + [("всего", all_latencies)]:
+        print(f"{label:<12}{len(values):>8}{percentile(values, .5):>10.1f}"
+              f"{percentile(values, .95):>10.1f}{percentile(values, .99):>10.1f}")
+    print(f"\nПисатель занят: {writer_time:.2f} с ({writer_time / elapsed:.0%} времени прогона)")
+    # Читателей несколько, загрузка — доля от их суммарного времени
+    print(f"Читатели заняты: {reader_time:.2f} с (загрузка "
+          f"{reader_time / (elapsed * db.storage.readers_count):.0%} из {db.storage.readers_count})")
+    # В WAL с synchronous=NORMAL коммит не делает fsync — диск синхронизируется только на checkpoint
+    print(f"Коммитов: {commits}, на обновление: {commits / max(recorder.processed, 1):.3f}")
+    print(f"Вызовы Bot API: {dict(fake.calls)}, из них 429: {fake.errors}")
+    throttled = {dict(labels)["action"]: int(value) for (name, labels), value in metrics.registry.counters.items()
+                 if name == "throttled_total"}
+    print(f"Отсечено антифлудом: {throttled}")
+    shed = {dict(labels)["priority"]: int(value) for (name, labels), value in metrics.registry.counters.items()
+            if name == "scheduler_shed_total"}
+    print(f"Сброшено планировщиком: {shed}")
+
+
+async def run(args):
+    scenarios = args.scenarios.split(",")
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        db.storage = db.Storage(os.path.join(workdir, "bench.db"))
+        await db.init_db()
+        withdrawal_ids = await seed(scenarios, args.updates)
+
+        fake = FakeTelegram(latency=args.latency / 1000, error_rate=args.error_rate, member_rate=args.member_rate)
+        runner, base_url = await serve(fake)
+        bot = Bot(token="42:BENCH", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+        dp = create_dispatcher()
+
+        updates = generate(scenarios, args.updates, withdrawal_ids)
+        recorder = Recorder(len(updates))
+        dp.update.outer_middleware(recorder)
+        await notifier.start(bot)
+
+        commits, writer_time, reader_time = db.storage.commits, db.storage.writer_time, db.storage.reader_time
+        started = time.perf_counter()
+        if args.mode == "polling":
+            for label, update in updates:
+                fake.push_update(update)
+                recorder.labels[fake._update_id] = label
+            polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False,
+                                                           polling_timeout=1))
+            await recorder.done.wait()
+            await dp.stop_polling()
+            await polling
+        else:
+            # Как в webhook.py: предел приёма (кроме админа), дальше одновременность ограничивает планировщик
+            priority.scheduler.resize(args.concurrency)
+            intake = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+
+            async def feed(update_id: int, label: str, update: dict):
+                recorder.arrived[update_id] = time.perf_counter()
+                recorder.labels[update_id] = label
+                bounded = not priority.from_admin(update)
+                if bounded:
+                    await intake.acquire()
+                try:
+                    await dp.feed_raw_update(bot, {**update, "update_id": update_id})
+                except Exception:
+                    pass  # учтено в recorder.errors, как и в webhook-режиме прогон продолжается
+                finally:
+                    if bounded:
+                        intake.release()
+
+            await asyncio.gather(*(feed(i, label, update) for i, (label, update) in enumerate(updates, 1)))
+        elapsed = time.perf_counter() - started
+
+        report(recorder, elapsed, fake, db.storage.commits - commits, db.storage.writer_time - writer_time,
+               db.storage.reader_time - reader_time)
+        await notifier.stop()
+        await db.close_db()
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake Bot API")
+    parser.add_argument("--updates", type=int, default=1000, help="обновлений на сценарий")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--mode", choices=("feed", "polling"), default="feed")
+    parser.add_argument("--concurrency", type=int, default=100, help="бюджет хендлеров планировщика")
+    parser.add_argument("--latency", type=float, default=0, help="задержка Bot API, мс")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля ответов 429")
+    parser.add_argument("--member-rate", type=float, default=0.8, help="доля подписанных в getChatMember")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,74 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from database import init_db
-from handlers import start, menu, admin
+from config import BOT_TOKEN, BOT_MODE, WORKERS, METRICS_HOST, METRICS_PORT
+from database import init_db, close_db, sync_shared
+from fsm_storage import SQLiteStorage
+from notifier import notifier
+from broadcast import broadcaster
+from backup import backups
+from reverify import reverifier
+from webhook import run_webhook
+import metrics
+from handlers import start, menu, admin, members
+import throttling
+import priority
 
 logging.basicConfig(level=logging.INFO)
 
-async def main():
-    # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+def create_dispatcher():
+    dp = Dispatcher(storage=SQLiteStorage())
     
     # Подключение роутеров
     dp.include_router(start.router)
     dp.include_router(menu.router)
     dp.include_router(admin.router)
+    dp.include_router(members.router)
+    # Антифлуд только для пользовательских роутеров; админку и chat_member не трогаем
+    throttling.setup(start.router, menu.router)
+    # Очереди по приоритету: админ (в любом роутере) > деньги > меню > регистрации;
+    # под нагрузкой первыми сбрасываются /start
+    priority.setup({start.router: priority.ONBOARDING, menu.router: priority.MENU, admin.router: priority.MENU})
+    metrics.instrument(dp)
+    return dp
+
+async def main():
+    # Инициализация бота и диспетчера
+    bot = Bot(token=BOT_TOKEN)
+    metrics.instrument_bot(bot)
+    dp = create_dispatcher()
     
     # Инициализация базы данных
-    init_db()
+    await init_db()
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    await notifier.start(bot)
+    await broadcaster.resume(bot)
+    backups.start()
+    reverifier.start(bot)
+    # Базу может менять и другой процесс — например, python -m importer
+    syncer = asyncio.create_task(sync_shared())
     
     # Запуск бота
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            # allowed_updates включает chat_member — нужен для кэша подписок
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        syncer.cancel()
+        await broadcaster.stop()
+        await backups.stop()
+        await reverifier.stop()
+        await notifier.stop()
+        await close_db()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        from supervisor import run_supervisor
+        asyncio.run(run_supervisor())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+import metrics
+import utils
+from notifier import notifier
+
+# Рассылка занимает не весь лимит: остаток остаётся обычным ответам бота
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 25
+CHUNK_SIZE = 200
+THROUGHPUT_WINDOW = 30
+
+
+class Broadcaster:
+    """Рассылка по всей базе: курсор по users.id, контрольные точки и пауза при занятой очереди."""
+
+    def __init__(self, rate: float = BROADCAST_RATE):
+        self.limiter = utils.RateLimiter(rate, BROADCAST_CONCURRENCY)
+        self.broadcast_id = None
+        self._task = None
+        self._stopping = False
+        self._cancelled = False
+        self._progress = deque()  # (время, отправлено всего) для оценки скорости
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot: Bot, text: str) -> int:
+        if self.running:
+            raise RuntimeError("Broadcast is already running")
+        broadcast_id = await db.create_broadcast(text, await db.get_total_users())
+        self._launch(bot, broadcast_id)
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Продолжает рассылку, прерванную перезапуском, с последней контрольной точки."""
+        row = await db.get_broadcast()
+        if row is not None and not self.running:
+            logging.info("Resuming broadcast %s after user %s", row[0], row[3])
+            self._launch(bot, row[0])
+
+    async def stop(self):
+        """Останавливает рассылку при выключении бота; после перезапуска она продолжится."""
+        self._stopping = True
+        if self._task is not None:
+            await asyncio.wait([self._task])
+
+    async def cancel(self):
+        self._cancelled = True
+        await self.stop()
+
+    def _launch(self, bot: Bot, broadcast_id: int):
+        self.broadcast_id = broadcast_id
+        self._stopping = False
+        self._cancelled = False
+        self._progress.clear()
+        self._task = asyncio.create_task(self._run(bot, broadcast_id))
+
+    def throughput(self) -> float:
+        if len(self._progress) < 2:
+            return 0.0
+        (t0, sent0), (t1, sent1) = self._progress[0], self._progress[-1]
+        return (sent1 - sent0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def _record(self, sent_total: int):
+        now = time.monotonic()
+        self._progress.append((now, sent_total))
+        while self._progress and now - self._progress[0][0] > THROUGHPUT_WINDOW:
+            self._progress.popleft()
+
+    async def _send(self, bot: Bot, user_id: int, text: str, result: dict):
+        try:
+            for _ in range(3):
+                try:
+                    await bot.send_message(user_id, text, parse_mode="HTML")
+                    result["sent"] += 1
+                    return
+                except TelegramRetryAfter as e:
+                    self.limiter.pause(e.retry_after)
+                    notifier.limiter.pause(e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+            result["failed"] += 1
+        except TelegramForbiddenError:
+            result["blocked"].append(user_id)
+        except TelegramBadRequest:
+            result["failed"] += 1
+        except Exception:
+            logging.exception("Broadcast message to %s failed", user_id)
+            result["failed"] += 1
+        finally:
+            self.limiter.release()
+            notifier.limiter.release()
+
+    async def _run(self, bot: Bot, broadcast_id: int):
+        row = await db.get_broadcast(broadcast_id)
+        _, text, _, last_user_id, _, sent_total, _, _, _ = row
+        self._record(sent_total)
+        status = "done"
+        try:
+            while not self._stopping:
+                user_ids = await db.get_recipients(last_user_id, CHUNK_SIZE)
+                if not user_ids:
+                    break
+                result = {"sent": 0, "failed": 0, "blocked": []}
+                tasks = []
+                for user_id in user_ids:
+                    # Обычные уведомления бота идут первыми: пока их очередь не пуста, рассылка ждёт
+                    while notifier.queued:
+                        await asyncio.sleep(0.1)
+                    await self.limiter.acquire()
+                    await notifier.limiter.acquire()
+                    tasks.append(asyncio.create_task(self._send(bot, user_id, text, result)))
+                await asyncio.gather(*tasks)
+                last_user_id = user_ids[-1]
+                await db.checkpoint_broadcast(broadcast_id, last_user_id, result["sent"],
+                                              result["failed"], result["blocked"])
+                sent_total += result["sent"]
+                self._record(sent_total)
+            if self._stopping:
+                status = "cancelled" if self._cancelled else "running"
+        except Exception:
+            logging.exception("Broadcast %s crashed, it will resume on restart", broadcast_id)
+            return
+        if status != "running":
+            await db.set_broadcast_status(broadcast_id, status)
+
+
+broadcaster = Broadcaster()
+metrics.registry.collect("broadcast_messages_per_second", broadcaster.throughput)
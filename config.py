@@ -5,3 +5,40 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
+REF_REWARD = int(os.getenv("REF_REWARD", 12))
+# Бонусы за рефералов 2-го и 3-го уровня (рефералы ваших рефералов), рубли; 0 — уровень выключен
+REF_REWARD_2 = float(os.getenv("REF_REWARD_2", 0))
+REF_REWARD_3 = float(os.getenv("REF_REWARD_3", 0))
+REF_REWARDS = (REF_REWARD, REF_REWARD_2, REF_REWARD_3)
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # внешний адрес; пусто — webhook не регистрируется
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько обновлений webhook держит в работе (в очереди планировщика и в хендлерах); сверх этого
+# ответ Telegram задерживается, и он сам придерживает новые обновления. Админа лимит не касается
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 256))
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+
+# Число процессов-обработчиков; больше 1 — супервизор раздаёт обновления воркерам по user_id
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 50))
+
+# Приоритеты обработки (priority.py): сколько хендлеров процесс выполняет одновременно
+# (в воркерах супервизора — WORKER_CONCURRENCY) и сколько секунд /start может ждать в очереди,
+# прежде чем получить «попробуйте через минуту» вместо обработки
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 64))
+SHED_SLO = float(os.getenv("SHED_SLO", 2))
+
+# Локальный endpoint метрик в формате Prometheus (/metrics); 0 — выключен.
+# Воркеры супервизора слушают следующие порты: METRICS_PORT + 1 + номер воркера
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+# Онлайн-копии базы: каталог, период в часах (0 — только по /backup) и сколько копий хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", 24))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))
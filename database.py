@@ -1,12 +1,476 @@
-import sqlite3
+import asyncio
+import contextvars
 import datetime
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from types import MappingProxyType
+
+import aiosqlite
+
+import metrics
 
 DB_NAME = "bot.db"
+READERS = 4
+STATEMENT_CACHE = 256
+# Окно группового коммита: записи, пришедшие за это время, идут одной транзакцией
+GROUP_COMMIT_DELAY = 0.005
+GROUP_COMMIT_MAX = 512
+# Онлайн-копия: страниц за шаг и пауза между шагами (≈1 МБ на шаг при страницах по 4 КБ)
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.02
+EXPORT_CHUNK = 1000
+WITHDRAWALS_PAGE = 10
+REFERRALS_PAGE = 10
+LEADERBOARD_SIZE = 100
+# Запас под топом: списания выталкивают из него лидеров, полная пересборка — раз на столько вылетов
+LEADERBOARD_SLACK = 100
+USER_CACHE_SIZE = 50_000
+# Очередь к читателям и групповому коммиту: меньше — раньше. Хендлеры выставляют номер своего
+# класса приоритета (priority.py: 0 — админ … 3 — регистрации), остальные запросы идут как меню
+query_priority = contextvars.ContextVar("query_priority", default=2)
+# Лента изменений пользователей для других процессов живёт столько секунд
+USER_CHANGES_TTL = 300
+# Как часто процесс подхватывает настройки и пользователей, изменённых другими процессами
+SHARED_SYNC_INTERVAL = 2
+# Деньги в ledger и балансах — целые копейки; заявки на вывод — целые рубли
+KOPECKS = 100
+LEDGER_COMPACT_INTERVAL = 60
+# Глубина дерева рефералов в таблице замыканий (и максимум уровней бонусов)
+REFERRAL_DEPTH = 3
+MAX_ID = 2 ** 63 - 1
+# Первая перепроверка подписки приглашённого — через час после начисления (см. reverify.py)
+REVERIFY_FIRST_CHECK = 3600
+# Сколько пользователей на проверке антифрода показывать в /holds
+HOLDS_PAGE = 10
+# Число рефералов — проводки referral минус отзывы clawback (бонус за отписавшегося)
+REFERRAL_KINDS = ("referral",) + tuple(f"referral_{level}" for level in range(2, REFERRAL_DEPTH + 1))
+# Строка пользователя: баланс, замороженное на выводе и число рефералов —
+# снимок из balances плюс хвост ledger после него (короткий диапазон по индексу user_id, id)
+USER_SELECT = """
+    SELECT u.id, u.username, u.referrer_id,
+           COALESCE(b.balance, 0) + COALESCE(t.balance, 0),
+           COALESCE(b.referrals, 0) + COALESCE(t.referrals, 0),
+           u.rewarded, u.joined_at, u.blocked,
+           COALESCE(b.held, 0) + COALESCE(t.held, 0),
+           COALESCE(d.size, 0), u.hold
+    FROM users u
+    LEFT JOIN balances b ON b.user_id = u.id
+    LEFT JOIN downline d ON d.user_id = u.id
+    LEFT JOIN (
+        SELECT user_id,
+               SUM(CASE WHEN account = 'balance' THEN amount ELSE 0 END) AS balance,
+               SUM(CASE WHEN account = 'held' THEN amount ELSE 0 END) AS held,
+               SUM((kind = 'referral') - (kind = 'clawback')) AS referrals
+        FROM ledger
+        WHERE user_id = :id AND id > COALESCE((SELECT ledger_id FROM balances WHERE user_id = :id), 0)
+    ) t ON t.user_id = u.id
+    WHERE u.id = :id
+"""
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+@contextmanager
+def prioritized(level: int):
+    """Запросы внутри блока встают в очереди к базе с приоритетом level."""
+    token = query_priority.set(level)
+    try:
+        yield
+    finally:
+        query_priority.reset(token)
+
+
+class Storage:
+    """Пул долгоживущих соединений: один писатель и несколько читателей (WAL)."""
+
+    def __init__(self, path: str, readers: int = READERS):
+        self.path = path
+        self.readers_count = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = []
+        self._waiting = []  # куча (query_priority, порядковый номер, future)
+        self._sequence = itertools.count()
+        self._connections = []
+        self._pending = asyncio.PriorityQueue()  # (query_priority, порядковый номер, op, future)
+        self._batch_level = None  # приоритет пачки, которая сейчас пишется
+        self._preempted = False
+        self._flusher = None
+        # Счётчики для нагрузочных тестов и метрик
+        self.commits = 0
+        self.writer_time = 0.0
+        self.reader_time = 0.0
+
+    async def _connect(self, readonly: bool = False):
+        # isolation_level=None — транзакциями управляем сами (BEGIN/COMMIT),
+        # cached_statements — подготовленные запросы переиспользуются между вызовами
+        conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=STATEMENT_CACHE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only=ON")
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # Писатель открывается первым: он переключает файл в режим WAL
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            self._readers.append(await self._connect(readonly=True))
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            # Дожидаемся, пока накопленные записи уйдут на диск
+            await self._pending.join()
+            self._flusher.cancel()
+            self._flusher = None
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        self._writer = None
+        self._readers = []
+
+    def _release_reader(self, conn):
+        while self._waiting:
+            waiter = heapq.heappop(self._waiting)[2]
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self._readers.append(conn)
+
+    @asynccontextmanager
+    async def reader(self):
+        waited = time.perf_counter()
+        if self._readers and not self._waiting:
+            conn = self._readers.pop()
+        else:
+            # Свободного читателя нет: первым его получит ждущий с меньшим query_priority
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiting, (query_priority.get(), next(self._sequence), waiter))
+            try:
+                conn = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release_reader(waiter.result())
+                raise
+        started = time.perf_counter()
+        metrics.registry.observe("db_reader_wait_seconds", started - waited)
+        try:
+            yield conn
+        finally:
+            self.reader_time += time.perf_counter() - started
+            self._release_reader(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        waited = time.perf_counter()
+        async with self._write_lock:
+            started = time.perf_counter()
+            metrics.registry.observe("db_writer_wait_seconds", started - waited)
+            try:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._writer
+                except BaseException:
+                    await self._writer.execute("ROLLBACK")
+                    raise
+                await self._writer.execute("COMMIT")
+                self.commits += 1
+            finally:
+                elapsed = time.perf_counter() - started
+                self.writer_time += elapsed
+                metrics.registry.observe("db_transaction_seconds", elapsed)
+
+    async def submit(self, op):
+        """Ставит op(conn) в очередь группового коммита и ждёт его результат.
+
+        Пачка — записи одного query_priority, самого высокого из ждущих. Запись с более высоким
+        приоритетом обрывает текущую пачку: сделанное коммитится, остаток возвращается в очередь,
+        так что записи админа и выводов не ждут сотен записей регистраций.
+        """
+        future = asyncio.get_running_loop().create_future()
+        level = query_priority.get()
+        if self._batch_level is not None and level < self._batch_level:
+            self._preempted = True
+        self._pending.put_nowait((level, next(self._sequence), op, future))
+        return await future
+
+    def _drain(self, first):
+        batch = [first]
+        while not self._pending.empty() and len(batch) < GROUP_COMMIT_MAX:
+            item = self._pending.get_nowait()
+            if item[0] != first[0]:
+                # Дальше только записи ниже приоритетом — им следующая пачка
+                self._pending.put_nowait(item)
+                self._pending.task_done()
+                break
+            batch.append(item)
+        return batch
+
+    async def _flush_loop(self):
+        while True:
+            first = await self._pending.get()
+            await asyncio.sleep(GROUP_COMMIT_DELAY)
+            # Пока шло окно, могли прийти записи важнее first — пачку начинает самая важная
+            self._pending.put_nowait(first)
+            self._pending.task_done()
+            batch = self._drain(self._pending.get_nowait())
+            await self._commit_batch(batch)
+            for _ in batch:
+                self._pending.task_done()
+
+    async def _commit_batch(self, batch):
+        results = []
+        rest = []
+        self._batch_level, self._preempted = batch[0][0], False
+        try:
+            async with self.transaction() as conn:
+                for index, (_, _, op, future) in enumerate(batch):
+                    if self._preempted and index:
+                        rest = batch[index:]
+                        break
+                    # Каждая операция в своём savepoint: ошибка одной не откатывает остальные
+                    await conn.execute("SAVEPOINT op")
+                    try:
+                        results.append((future, await op(conn), None))
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO op")
+                        results.append((future, None, e))
+                    await conn.execute("RELEASE op")
+        except Exception as e:
+            logging.exception("Group commit of %d operations failed", len(batch) - len(rest))
+            for *_, future in batch[:len(batch) - len(rest)]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._batch_level = None
+            metrics.registry.observe("db_commit_batch_size", len(batch) - len(rest), buckets=metrics.SIZE_BUCKETS)
+            # Невыполненный остаток оборванной пачки — в следующие пачки
+            for item in rest:
+                self._pending.put_nowait(item)
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def backup(self, target: str, pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE):
+        """Копия базы в target через online backup API, шагами по pages страниц.
+
+        Отдельное соединение открывает читающую транзакцию и держит снимок WAL до конца копии:
+        записи писателя идут как обычно и не перезапускают копирование, а копия согласована.
+        Шаги и паузы выполняются в потоке этого соединения, цикл событий не ждёт.
+        """
+        source = await aiosqlite.connect(self.path, isolation_level=None)
+        target_conn = sqlite3.connect(target, check_same_thread=False)
+        started = time.perf_counter()
+        try:
+            await source.execute("BEGIN")
+            async with source.execute("SELECT COUNT(*) FROM sqlite_master") as cur:
+                await cur.fetchone()
+            await source.backup(target_conn, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+            await source.execute("COMMIT")
+        finally:
+            target_conn.close()
+            await source.close()
+            metrics.registry.observe("db_backup_seconds", time.perf_counter() - started)
+
+    async def fetchone(self, sql: str, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+    async def execute(self, sql: str, params=()) -> int:
+        async def op(conn):
+            async with conn.execute(sql, params) as cur:
+                return cur.rowcount
+        return await self.submit(op)
+
+
+class User:
+    """Пользователь; balance и held — в копейках, downline — рефералы на всех уровнях дерева,
+    hold — причина, по которой бонусы и выводы пользователя задержаны антифродом (None — не задержаны)."""
+
+    __slots__ = ("id", "username", "referrer_id", "balance", "referrals_count", "rewarded", "joined_at", "blocked",
+                 "held", "downline", "hold")
+
+    def __init__(self, id, username, referrer_id, balance, referrals_count, rewarded, joined_at, blocked, held,
+                 downline, hold):
+        self.id = id
+        self.username = username
+        self.referrer_id = referrer_id
+        self.balance = balance
+        self.referrals_count = referrals_count
+        self.rewarded = rewarded
+        self.joined_at = joined_at
+        self.blocked = blocked
+        self.held = held
+        self.downline = downline
+        self.hold = hold
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("""
+
+class UserCache:
+    """LRU записей пользователей. Пишущие функции кладут сюда свежую строку после коммита,
+    чтение с диска добавляет запись, только если её никто не успел обновить."""
+
+    def __init__(self, size: int = USER_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, user_id: int):
+        user = self._entries.get(user_id)
+        metrics.registry.inc("user_cache_total", result="miss" if user is None else "hit")
+        if user is not None:
+            self._entries.move_to_end(user_id)
+        return user
+
+    def _store(self, user: User):
+        self._entries[user.id] = user
+        self._entries.move_to_end(user.id)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def put(self, row) -> User:
+        user = User(*row)
+        self._store(user)
+        return user
+
+    def add(self, row) -> User:
+        user = self._entries.get(row[0])
+        if user is None:
+            user = User(*row)
+            self._store(user)
+        return user
+
+    def discard(self, user_ids):
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Leaderboard:
+    """Рейтинг по числу рефералов в памяти: счёт каждого реферера, гистограмма «рефералов → пользователей»
+    для места любого из них и отсортированная верхушка из size + slack мест для топа.
+    Меняется точечно после начислений и списаний."""
+
+    def __init__(self, size: int = LEADERBOARD_SIZE, slack: int = LEADERBOARD_SLACK):
+        self.size = size
+        self.capacity = size + slack
+        self._scores = {}
+        self._histogram = {}
+        # [(-рефералов, user_id)] по возрастанию — начало общего порядка: все, кого в нём нет, стоят ниже
+        self._top = []
+
+    def load(self, rows):
+        self._scores = {user_id: score for user_id, score in rows if score > 0}
+        self._histogram = {}
+        for score in self._scores.values():
+            self._histogram[score] = self._histogram.get(score, 0) + 1
+        self._rebuild()
+
+    def _rebuild(self):
+        self._top = heapq.nsmallest(self.capacity, ((-score, user_id) for user_id, score in self._scores.items()))
+
+    def set(self, user_id: int, score: int):
+        old = self._scores.get(user_id, 0)
+        if score == old:
+            return
+        if old:
+            self._histogram[old] -= 1
+            if not self._histogram[old]:
+                del self._histogram[old]
+        if score > 0:
+            self._scores[user_id] = score
+            self._histogram[score] = self._histogram.get(score, 0) + 1
+        else:
+            self._scores.pop(user_id, None)
+        entry = (-old, user_id)
+        index = bisect_left(self._top, entry)
+        in_top = index < len(self._top) and self._top[index] == entry
+        if in_top:
+            del self._top[index]
+        entry = (-score, user_id)
+        # Место в верхушке известно, если пользователь поднялся из неё, если вне её никого нет
+        # или если он выше её последнего; иначе он остаётся ниже — как и все, кого в ней нет
+        outside = len(self._scores) - len(self._top) - (score > 0)
+        if score > 0 and ((in_top and score > old) or not outside or (self._top and entry < self._top[-1])):
+            insort(self._top, entry)
+            del self._top[self.capacity:]
+        if len(self._top) < self.size and len(self._top) < len(self._scores):
+            # Списания исчерпали запас — пересобираем из памяти
+            self._rebuild()
+
+    def top(self, limit: int):
+        """[(user_id, рефералов)] — первые limit мест."""
+        return [(user_id, -score) for score, user_id in self._top[:limit]]
+
+    def rank(self, user_id: int):
+        """(место, участников рейтинга); место None, если рефералов нет. Равные делят место."""
+        score = self._scores.get(user_id, 0)
+        if not score:
+            return None, len(self._scores)
+        return 1 + sum(count for value, count in self._histogram.items() if value > score), len(self._scores)
+
+    def __len__(self):
+        return len(self._scores)
+
+
+storage = Storage(DB_NAME)
+users = UserCache()
+leaderboard = Leaderboard()
+# Включается в воркерах (WORKERS>1): чужие балансы меняют и другие процессы
+share_user_changes = False
+_user_changes_seq = 0
+_user_changes_purged = 0.0
+_compactor = None
+metrics.registry.collect("user_cache_entries", lambda: len(users))
+metrics.registry.collect("leaderboard_entries", lambda: len(leaderboard))
+metrics.registry.collect("db_commits_total", lambda: storage.commits, "counter")
+metrics.registry.collect("db_writer_busy_seconds_total", lambda: storage.writer_time, "counter")
+metrics.registry.collect("db_reader_busy_seconds_total", lambda: storage.reader_time, "counter")
+
+# Снимок настроек в памяти; меняется только целиком при записи из админки
+_settings = MappingProxyType({"channel": "", "channels": (), "enabled": False, "throttle": "", "version": 0})
+
+
+async def _add_column(conn, table, column, decl):
+    async with conn.execute(f"PRAGMA table_info({table})") as cur:
+        columns = [row[1] for row in await cur.fetchall()]
+    if column not in columns:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _schema_v1(conn):
+    """Схема до появления версий. Каждая команда идемпотентна, поэтому шаг годится
+    для базы, созданной любой прежней версией бота."""
+    await conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
             username TEXT,
@@ -17,14 +481,14 @@ def init_db():
             joined_at TEXT
         )
     """)
-    cur.execute("""
+    await conn.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             id INTEGER PRIMARY KEY CHECK (id = 1),
             required_channel TEXT,
             check_subscription INTEGER DEFAULT 0
         )
     """)
-    cur.execute("""
+    await conn.execute("""
         CREATE TABLE IF NOT EXISTS withdrawals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -33,108 +497,1204 @@ def init_db():
             created_at TEXT
         )
     """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created ON withdrawals (status, created_at)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            text TEXT,
+            created_at TEXT
+        )
+    """)
+    # Состояния FSM (см. fsm_storage.py)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm (expires_at)")
+    # Счётчики для админской статистики: итоги и почасовые/подневные корзины
+    await conn.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER DEFAULT 0)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_buckets (
+            period TEXT,
+            bucket TEXT,
+            metric TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (period, bucket, metric)
+        )
+    """)
+    async with conn.execute("SELECT 1 FROM stats LIMIT 1") as cur:
+        seeded = await cur.fetchone()
+    if not seeded:
+        # Единственный полный проход по users — при первом запуске со статистикой
+        await conn.execute("INSERT INTO stats (key, value) SELECT 'signups', COUNT(*) FROM users")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+    """)
+    await _add_column(conn, "settings", "version", "INTEGER DEFAULT 0")
+    # Лимиты нажатий для антифлуда: «profile=5/10 check_sub=3/10»
+    await _add_column(conn, "settings", "throttle_limits", "TEXT DEFAULT ''")
+    await _add_column(conn, "users", "blocked", "INTEGER DEFAULT 0")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            pid INTEGER,
+            changed_at REAL
+        )
+    """)
+    # Деньги: только дописываемые проводки и периодические снимки балансов по ним
+    async with conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ledger'") as cur:
+        has_ledger = await cur.fetchone()
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            account TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            ref_id INTEGER,
+            created_at TEXT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, id)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS balances (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER DEFAULT 0,
+            held INTEGER DEFAULT 0,
+            referrals INTEGER DEFAULT 0,
+            ledger_id INTEGER DEFAULT 0
+        )
+    """)
+    if not has_ledger:
+        await _open_ledger(conn)
+    # Дерево рефералов: пара (предок, потомок) на каждом уровне до REFERRAL_DEPTH
+    async with conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'referral_tree'") as cur:
+        has_tree = await cur.fetchone()
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_tree (
+            ancestor INTEGER NOT NULL,
+            descendant INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor, descendant)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_tree_descendant ON referral_tree (descendant, depth)")
+    await conn.execute("CREATE TABLE IF NOT EXISTS downline (user_id INTEGER PRIMARY KEY, size INTEGER DEFAULT 0)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_downline_size ON downline (size DESC, user_id)")
+    if not has_tree:
+        await _build_referral_tree(conn)
     # Вставляем настройки по умолчанию, если их нет
-    cur.execute("INSERT OR IGNORE INTO settings (id, required_channel, check_subscription) VALUES (1, '', 0)")
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, username, referrer_id=None):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if cur.fetchone():
-        conn.close()
-        return False
+    await conn.execute("INSERT OR IGNORE INTO settings (id, required_channel, check_subscription) VALUES (1, '', 0)")
+
+
+async def _schema_v2(conn):
+    # Рефералы пользователя по ключу: в индексе после referrer_id идёт rowid (id)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer ON users (referrer_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users (joined_at)")
+    # Импорт из старых баз (importer.py): докуда дошли, чтобы продолжить после сбоя без повторных начислений
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS imports (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER DEFAULT 0,
+            imported INTEGER DEFAULT 0,
+            merged INTEGER DEFAULT 0,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    """)
+
+
+async def _schema_v3(conn):
+    # Очередь перепроверки подписок: приоритет зашит в due_at, поэтому выборка — диапазон по индексу
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS reverify (
+            user_id INTEGER PRIMARY KEY,
+            channels TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            rewarded_at REAL NOT NULL,
+            due_at REAL NOT NULL,
+            checks INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_reverify_due ON reverify (due_at)")
+    # Начисления за конкретного приглашённого (ref_id) — для отзыва бонуса
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_ref ON ledger (ref_id, kind)")
+    # Уже выплаченные бонусы попадают в очередь, если проверка подписки включена;
+    # первые проверки размазываются по суткам
+    now = time.time()
+    await conn.execute(f"""
+        INSERT OR IGNORE INTO reverify (user_id, channels, amount, rewarded_at, due_at)
+        SELECT l.ref_id, s.required_channel, SUM(l.amount),
+               -- created_at — локальное время без зоны: 'utc' переводит его в UTC перед '%s'
+               COALESCE(CAST(strftime('%s', MIN(l.created_at), 'utc') AS REAL), :now),
+               :now + ABS(random() % 86400)
+        FROM ledger l
+        JOIN settings s ON s.id = 1 AND s.check_subscription = 1 AND s.required_channel != ''
+        JOIN users u ON u.id = l.ref_id AND u.rewarded = 1
+        WHERE l.kind IN ({", ".join(f"'{kind}'" for kind in REFERRAL_KINDS)})
+        GROUP BY l.ref_id
+    """, {"now": now})
+
+
+async def _schema_v4(conn):
+    # Антифрод: причина задержки выплат реферера; задержанных единицы — частичный индекс
+    await _add_column(conn, "users", "hold", "TEXT")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_hold ON users (id) WHERE hold IS NOT NULL")
+
+
+async def _schema_v5(conn):
+    # Раньше вместо пустого username писалась заглушка — списки показывали «@no_username»
+    await conn.execute("UPDATE users SET username = NULL WHERE username = 'no_username'")
+
+
+# Шаги схемы по порядку; номер применённого хранится в PRAGMA user_version.
+# Новые изменения — только новым шагом в конце списка
+MIGRATIONS = (_schema_v1, _schema_v2, _schema_v3, _schema_v4, _schema_v5)
+
+
+async def migrate():
+    """Доводит схему до последней версии; на актуальной базе это одно чтение заголовка."""
+    current = (await storage.fetchone("PRAGMA user_version"))[0]
+    if current >= len(MIGRATIONS):
+        return
+    async with storage.transaction() as conn:
+        # Воркеры стартуют одновременно — версию перечитываем под блокировкой писателя
+        async with conn.execute("PRAGMA user_version") as cur:
+            current = (await cur.fetchone())[0]
+        for version in range(current, len(MIGRATIONS)):
+            await MIGRATIONS[version](conn)
+            await conn.execute(f"PRAGMA user_version = {version + 1}")
+    if current < len(MIGRATIONS):
+        logging.info("Database schema migrated from v%d to v%d", current, len(MIGRATIONS))
+
+
+async def init_db():
+    global _user_changes_seq
+    await storage.open()
+    await migrate()
+    await refresh_settings()
+    users.clear()
+    await _load_leaderboard()
+    _user_changes_seq = (await storage.fetchone("SELECT COALESCE(MAX(seq), 0) FROM user_changes"))[0]
+    global _compactor
+    if _compactor is None:
+        _compactor = asyncio.create_task(_compact_loop())
+
+
+async def _open_ledger(conn):
+    """Переход на ledger: остатки из users.balance (рубли), заморозка под уже поданные заявки,
+    прежние счётчики рефералов и денежная статистика в копейках."""
+    created = datetime.datetime.now().isoformat()
+    await conn.execute("""
+        INSERT INTO ledger (user_id, kind, account, amount, created_at)
+        SELECT id, 'opening', 'balance', balance * ?, ? FROM users WHERE balance != 0
+    """, (KOPECKS, created))
+    for account, sign in (("balance", -1), ("held", 1)):
+        await conn.execute("""
+            INSERT INTO ledger (user_id, kind, account, amount, ref_id, created_at)
+            SELECT user_id, 'hold', ?, amount * ?, id, ? FROM withdrawals WHERE status = 'pending'
+        """, (account, sign * KOPECKS, created))
+    await conn.execute("""
+        INSERT INTO balances (user_id, referrals)
+        SELECT id, referrals_count FROM users WHERE referrals_count > 0
+    """)
+    await conn.execute("DELETE FROM stats WHERE key = 'balance'")
+    await conn.execute("INSERT INTO stats (key, value) SELECT 'balance_kop', COALESCE(SUM(amount), 0) FROM ledger")
+    for table in ("stats", "stats_buckets"):
+        key = "key" if table == "stats" else "metric"
+        await conn.execute(f"UPDATE {table} SET {key} = 'referral_kop', value = value * ? WHERE {key} = 'referral_amount'",
+                           (KOPECKS,))
+
+
+async def _build_referral_tree(conn):
+    """Заполняет дерево по users.referrer_id — уровень за уровнем, без рекурсии по каждому пользователю."""
+    for depth in range(1, REFERRAL_DEPTH + 1):
+        await _link_level(conn, depth)
+    await conn.execute("INSERT INTO downline (user_id, size) SELECT ancestor, COUNT(*) FROM referral_tree GROUP BY ancestor")
+
+
+async def _link_level(conn, depth, first_id=0, last_id=MAX_ID):
+    """Строки дерева уровня depth для пользователей с id в [first_id, last_id]; уровень depth - 1 уже построен."""
+    if depth == 1:
+        await conn.execute("""
+            INSERT OR IGNORE INTO referral_tree (ancestor, descendant, depth)
+            SELECT u.referrer_id, u.id, 1 FROM users u
+            WHERE u.id BETWEEN ? AND ? AND u.referrer_id != u.id
+              AND EXISTS (SELECT 1 FROM users r WHERE r.id = u.referrer_id)
+        """, (first_id, last_id))
+    else:
+        await conn.execute("""
+            INSERT OR IGNORE INTO referral_tree (ancestor, descendant, depth)
+            SELECT t.ancestor, u.id, t.depth + 1 FROM users u
+            JOIN referral_tree t ON t.descendant = u.referrer_id AND t.depth = ?
+            WHERE u.id BETWEEN ? AND ? AND t.ancestor != u.id
+        """, (depth - 1, first_id, last_id))
+
+
+async def _load_leaderboard():
+    # Один проход при старте: снимки balances плюс ещё не свёрнутый хвост ledger
+    leaderboard.load(await storage.fetchall("""
+        SELECT user_id, SUM(referrals) FROM (
+            SELECT user_id, referrals FROM balances WHERE referrals > 0
+            UNION ALL
+            SELECT user_id, SUM((kind = 'referral') - (kind = 'clawback')) FROM ledger
+            WHERE id > (SELECT COALESCE(MAX(ledger_id), 0) FROM balances) AND kind IN ('referral', 'clawback')
+            GROUP BY user_id
+        ) GROUP BY user_id
+    """))
+
+
+async def close_db():
+    global _compactor
+    if _compactor is not None:
+        _compactor.cancel()
+        _compactor = None
+    await storage.close()
+
+
+async def _track(conn, metric, delta=1, buckets=True):
+    """Увеличивает итоговый счётчик metric и (по умолчанию) его корзины за текущий час и день."""
+    await conn.execute("""
+        INSERT INTO stats (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = value + excluded.value
+    """, (metric, delta))
+    if buckets:
+        now = datetime.datetime.now()
+        await conn.executemany("""
+            INSERT INTO stats_buckets (period, bucket, metric, value) VALUES (?, ?, ?, ?)
+            ON CONFLICT (period, bucket, metric) DO UPDATE SET value = value + excluded.value
+        """, [("hour", now.strftime("%Y-%m-%dT%H"), metric, delta),
+              ("day", now.strftime("%Y-%m-%d"), metric, delta)])
+
+
+@metrics.timed("db_query_seconds")
+async def record_event(metric, delta=1):
+    async def op(conn):
+        await _track(conn, metric, delta)
+    await storage.submit(op)
+
+
+async def _log_user_changes(conn, user_ids):
+    if share_user_changes and user_ids:
+        now = time.time()
+        await conn.executemany("INSERT INTO user_changes (user_id, pid, changed_at) VALUES (?, ?, ?)",
+                               [(user_id, os.getpid(), now) for user_id in user_ids])
+
+
+async def _load_user(conn, user_id):
+    async with conn.execute(USER_SELECT, {"id": user_id}) as cur:
+        return await cur.fetchone()
+
+
+async def _post(conn, entries):
+    """Дописывает проводки (user_id, kind, account, amount в копейках, ref_id); строки users не трогаются."""
+    created = datetime.datetime.now().isoformat()
+    await conn.executemany("""
+        INSERT INTO ledger (user_id, kind, account, amount, ref_id, created_at) VALUES (?, ?, ?, ?, ?, ?)
+    """, [(*entry, created) for entry in entries])
+    # balance_kop — всё, что бот должен пользователям: доступное и замороженное на выводе
+    total = sum(entry[3] for entry in entries)
+    if total:
+        await _track(conn, "balance_kop", total, buckets=False)
+    await _log_user_changes(conn, list({entry[0] for entry in entries}))
+
+
+@metrics.timed("db_query_seconds")
+async def add_user(user_id, username, referrer_id=None):
     joined = datetime.datetime.now().isoformat()
-    cur.execute("""
-        INSERT INTO users (id, username, referrer_id, joined_at)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, username, referrer_id, joined))
-    conn.commit()
-    conn.close()
-    return True
-
-def get_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cur.fetchone()
-    conn.close()
+    async def op(conn):
+        async with conn.execute("""
+            INSERT OR IGNORE INTO users (id, username, referrer_id, joined_at)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, username, referrer_id, joined)) as cur:
+            inserted = cur.rowcount == 1
+        if not inserted:
+            # Снова нажал /start — значит, разблокировал бота: рассылки до него опять доходят
+            async with conn.execute("UPDATE users SET blocked = 0 WHERE id = ? AND blocked = 1", (user_id,)) as cur:
+                if not cur.rowcount:
+                    return False, []
+            await _log_user_changes(conn, [user_id])
+            return False, [await _load_user(conn, user_id)]
+        await _track(conn, "signups")
+        ancestors = await _link_referral(conn, user_id, referrer_id) if referrer_id not in (None, user_id) else []
+        return True, [await _load_user(conn, uid) for uid in [user_id] + ancestors]
+    inserted, rows = await storage.submit(op)
+    for row in rows:
+        users.put(row)
+    return inserted
+
+
+async def _link_referral(conn, user_id, referrer_id):
+    """Добавляет нового пользователя в дерево под referrer_id; возвращает id всех его предков."""
+    params = {"id": user_id, "ref": referrer_id, "depth": REFERRAL_DEPTH}
+    await conn.execute("""
+        INSERT INTO referral_tree (ancestor, descendant, depth)
+        SELECT :ref, :id, 1 WHERE EXISTS (SELECT 1 FROM users WHERE id = :ref)
+        UNION ALL
+        SELECT ancestor, :id, depth + 1 FROM referral_tree WHERE descendant = :ref AND depth < :depth
+    """, params)
+    async with conn.execute("""
+        INSERT INTO downline (user_id, size)
+        SELECT ancestor, 1 FROM referral_tree WHERE descendant = :id
+        ON CONFLICT (user_id) DO UPDATE SET size = size + 1
+        RETURNING user_id
+    """, params) as cur:
+        ancestors = [row[0] for row in await cur.fetchall()]
+    await _log_user_changes(conn, ancestors)
+    return ancestors
+
+
+async def _get_user(user_id):
+    user = users.get(user_id)
+    if user is None:
+        async with storage.reader() as conn:
+            row = await _load_user(conn, user_id)
+        if row is not None:
+            user = users.add(row)
     return user
 
-def update_user_balance(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-    conn.commit()
-    conn.close()
-
-def increment_referrals(referrer_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE id = ?", (referrer_id,))
-    conn.commit()
-    conn.close()
-
-def mark_rewarded(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET rewarded = 1 WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-
-def get_settings():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT required_channel, check_subscription FROM settings WHERE id = 1")
-    row = cur.fetchone()
-    conn.close()
-    return {"channel": row[0], "enabled": bool(row[1])}
-
-def update_settings(channel, enabled):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("UPDATE settings SET required_channel = ?, check_subscription = ? WHERE id = 1",
-                (channel, 1 if enabled else 0))
-    conn.commit()
-    conn.close()
-
-def add_withdrawal(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+
+@metrics.timed("db_query_seconds")
+async def get_user(user_id):
+    return await _get_user(user_id)
+
+
+@metrics.timed("db_query_seconds")
+async def adjust_balance(user_id, amount, kind="adjust"):
+    """Ручная корректировка баланса на amount копеек (может быть отрицательной)."""
+    async def op(conn):
+        await _post(conn, [(user_id, kind, "balance", amount, None)])
+        return await _load_user(conn, user_id)
+    row = await storage.submit(op)
+    if row is not None:
+        users.put(row)
+
+
+@metrics.timed("db_query_seconds")
+async def credit_referral(invitee_id, referrer_id, rewards):
+    """Начисляет бонусы за приглашённого ровно один раз: rewards[0] копеек рефереру,
+    rewards[1] — его рефереру и т.д. (в том числе задержанный антифродом бонус, rewarded = 3).
+    Возвращает [(user_id, сумма, уровень)] начислений."""
+    async def op(conn):
+        # compare-and-set по флагу rewarded приглашённого защищает от двойной выплаты;
+        # строки рефереров не обновляем — только дописываем проводки
+        async with conn.execute("""
+            UPDATE users SET rewarded = 1
+            WHERE id = ? AND rewarded IN (0, 3) AND referrer_id = ?
+              AND EXISTS (SELECT 1 FROM users WHERE id = ?)
+        """, (invitee_id, referrer_id, referrer_id)) as cur:
+            if cur.rowcount != 1:
+                return None
+        # Уровень 1 — сам реферер, выше — его предки из дерева (один индексный диапазон)
+        async with conn.execute("""
+            SELECT ancestor, depth + 1 FROM referral_tree
+            WHERE descendant = ? AND depth < ? ORDER BY depth
+        """, (referrer_id, len(rewards))) as cur:
+            levels = [(referrer_id, 1)] + list(await cur.fetchall())
+        credits = [(user_id, rewards[level - 1], level) for user_id, level in levels if rewards[level - 1] > 0]
+        await _post(conn, [(user_id, "referral" if level == 1 else f"referral_{level}", "balance", amount, invitee_id)
+                           for user_id, amount, level in credits])
+        await _log_user_changes(conn, [invitee_id])
+        # Бонус за подписку — значит, подписку будем перепроверять
+        if credits and _settings["enabled"] and _settings["channel"]:
+            now = time.time()
+            await conn.execute("""
+                INSERT OR REPLACE INTO reverify (user_id, channels, amount, rewarded_at, due_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (invitee_id, _settings["channel"], sum(amount for _, amount, _ in credits), now,
+                  now + REVERIFY_FIRST_CHECK))
+        await _track(conn, "referral_credits")
+        await _track(conn, "referral_kop", sum(amount for _, amount, _ in credits))
+        rows = [await _load_user(conn, user_id) for user_id in [invitee_id] + [c[0] for c in credits]]
+        return credits, rows
+    result = await storage.submit(op)
+    if result is None:
+        return []
+    credits, rows = result
+    for row in rows:
+        user = users.put(row)
+        leaderboard.set(user.id, user.referrals_count)
+    return credits
+
+
+@metrics.timed("db_query_seconds")
+async def get_reverify_due(now, limit):
+    """Приглашённые, чью подписку пора перепроверить: [(user_id, channels, amount, rewarded_at, checks)]."""
+    return await storage.fetchall("""
+        SELECT user_id, channels, amount, rewarded_at, checks FROM reverify
+        WHERE due_at <= ? ORDER BY due_at LIMIT ?
+    """, (now, limit))
+
+
+@metrics.timed("db_query_seconds")
+async def reschedule_reverify(due, dropped=()):
+    """Сдвигает следующие проверки [(user_id, due_at)] и убирает из очереди dropped — одной транзакцией."""
+    async def op(conn):
+        await conn.executemany("UPDATE reverify SET due_at = ?, checks = checks + 1 WHERE user_id = ?",
+                               [(due_at, user_id) for user_id, due_at in due])
+        await conn.executemany("DELETE FROM reverify WHERE user_id = ?", [(user_id,) for user_id in dropped])
+    await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def claw_back_referral(invitee_id):
+    """Отзывает бонусы за приглашённого, который отписался: обратные проводки clawback на всех уровнях,
+    rewarded = 2 (повторно бонус за него не начисляется). Возвращает [(user_id, сумма, уровень)]."""
+    async def op(conn):
+        await conn.execute("DELETE FROM reverify WHERE user_id = ?", (invitee_id,))
+        async with conn.execute("UPDATE users SET rewarded = 2 WHERE id = ? AND rewarded = 1", (invitee_id,)) as cur:
+            if cur.rowcount != 1:
+                return None
+        async with conn.execute(f"""
+            SELECT user_id, kind, amount FROM ledger
+            WHERE ref_id = ? AND kind IN ({", ".join("?" * len(REFERRAL_KINDS))})
+        """, (invitee_id, *REFERRAL_KINDS)) as cur:
+            credits = await cur.fetchall()
+        # referral -> clawback, referral_2 -> clawback_2
+        entries = [(user_id, "clawback" + kind[len("referral"):], "balance", -amount, invitee_id)
+                   for user_id, kind, amount in credits]
+        if entries:
+            await _post(conn, entries)
+        await _log_user_changes(conn, [invitee_id])
+        await _track(conn, "referral_clawbacks")
+        await _track(conn, "clawback_kop", sum(amount for _, _, amount in credits))
+        rows = [await _load_user(conn, user_id) for user_id in {invitee_id} | {c[0] for c in credits}]
+        return [(user_id, amount, REFERRAL_KINDS.index(kind) + 1) for user_id, kind, amount in credits], rows
+    result = await storage.submit(op)
+    if result is None:
+        return []
+    reversed_credits, rows = result
+    for row in rows:
+        user = users.put(row)
+        leaderboard.set(user.id, user.referrals_count)
+    return reversed_credits
+
+
+@metrics.timed("db_query_seconds")
+async def hold_referral(invitee_id, referrer_id):
+    """Откладывает бонус за приглашённого до решения админа по рефереру: rewarded 0 -> 3."""
+    async def op(conn):
+        async with conn.execute("""
+            UPDATE users SET rewarded = 3 WHERE id = ? AND rewarded = 0 AND referrer_id = ?
+        """, (invitee_id, referrer_id)) as cur:
+            if cur.rowcount != 1:
+                return None
+        await _log_user_changes(conn, [invitee_id])
+        await _track(conn, "referral_holds")
+        return await _load_user(conn, invitee_id)
+    row = await storage.submit(op)
+    if row is not None:
+        users.put(row)
+    return row is not None
+
+
+@metrics.timed("db_query_seconds")
+async def flag_referrer(user_id, reason):
+    """Ставит пользователя на проверку антифрода; False, если он уже на проверке или его нет."""
+    async def op(conn):
+        async with conn.execute("UPDATE users SET hold = ? WHERE id = ? AND hold IS NULL", (reason, user_id)) as cur:
+            if cur.rowcount != 1:
+                return None
+        await _log_user_changes(conn, [user_id])
+        await _track(conn, "fraud_flags")
+        return await _load_user(conn, user_id)
+    row = await storage.submit(op)
+    if row is not None:
+        users.put(row)
+    return row is not None
+
+
+@metrics.timed("db_query_seconds")
+async def get_held_referrers(limit=HOLDS_PAGE):
+    """Пользователи на проверке: [(id, username, причина, отложено бонусов, задержано заявок, их сумма)]."""
+    return await storage.fetchall("""
+        SELECT u.id, u.username, u.hold,
+               (SELECT COUNT(*) FROM users WHERE referrer_id = u.id AND rewarded = 3),
+               (SELECT COUNT(*) FROM withdrawals WHERE user_id = u.id AND status = 'held'),
+               (SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE user_id = u.id AND status = 'held')
+        FROM users u
+        WHERE u.hold IS NOT NULL
+        ORDER BY u.id LIMIT ?
+    """, (limit,))
+
+
+@metrics.timed("db_query_seconds")
+async def release_referrer(user_id):
+    """Снимает проверку: задержанные заявки возвращаются в очередь админа.
+
+    Возвращает (id приглашённых с отложенными бонусами, число заявок) или None, если проверки не было;
+    бонусы начисляет вызывающий через credit_referral — сумма зависит от текущих REF_REWARDS.
+    """
+    async def op(conn):
+        async with conn.execute("UPDATE users SET hold = NULL WHERE id = ? AND hold IS NOT NULL", (user_id,)) as cur:
+            if cur.rowcount != 1:
+                return None
+        async with conn.execute("""
+            UPDATE withdrawals SET status = 'pending' WHERE user_id = ? AND status = 'held' RETURNING id
+        """, (user_id,)) as cur:
+            withdrawals = len(await cur.fetchall())
+        async with conn.execute("SELECT id FROM users WHERE referrer_id = ? AND rewarded = 3", (user_id,)) as cur:
+            invitees = [row[0] for row in await cur.fetchall()]
+        await _log_user_changes(conn, [user_id])
+        return (invitees, withdrawals), await _load_user(conn, user_id)
+    result = await storage.submit(op)
+    if result is None:
+        return None
+    released, row = result
+    users.put(row)
+    return released
+
+
+@metrics.timed("db_query_seconds")
+async def reject_referrer(user_id):
+    """Отклоняет задержанное: отложенные бонусы отменяются (rewarded 3 -> 2), заявки отклоняются
+    с возвратом на баланс. Проверка остаётся. Возвращает (число бонусов, [(id, amount)] заявок)."""
+    async def op(conn):
+        async with conn.execute("""
+            UPDATE users SET rewarded = 2 WHERE referrer_id = ? AND rewarded = 3 RETURNING id
+        """, (user_id,)) as cur:
+            invitees = [row[0] for row in await cur.fetchall()]
+        async with conn.execute("""
+            UPDATE withdrawals SET status = 'rejected' WHERE user_id = ? AND status = 'held' RETURNING id, amount
+        """, (user_id,)) as cur:
+            withdrawals = await cur.fetchall()
+        entries = []
+        for withdrawal_id, amount in withdrawals:
+            entries.extend(_settlement(withdrawal_id, user_id, amount, "rejected"))
+        if entries:
+            await _post(conn, entries)
+        await _log_user_changes(conn, [user_id] + invitees)
+        return (len(invitees), withdrawals), [await _load_user(conn, uid) for uid in [user_id] + invitees]
+    result, rows = await storage.submit(op)
+    for row in rows:
+        if row is not None:
+            users.put(row)
+    return result
+
+
+@metrics.timed("db_query_seconds")
+async def get_downline_levels(user_id):
+    """{уровень: число рефералов} — по первичному ключу дерева, без обхода."""
+    rows = await storage.fetchall("""
+        SELECT depth, COUNT(*) FROM referral_tree WHERE ancestor = ? GROUP BY depth
+    """, (user_id,))
+    return dict(rows)
+
+
+@metrics.timed("db_query_seconds")
+async def get_downline_leaders(limit=10):
+    """[(user_id, username, размер команды)] по индексу idx_downline_size."""
+    return await storage.fetchall("""
+        SELECT d.user_id, u.username, d.size FROM downline d
+        JOIN users u ON u.id = d.user_id
+        ORDER BY d.size DESC, d.user_id LIMIT ?
+    """, (limit,))
+
+
+@metrics.timed("db_query_seconds")
+async def get_referrals_page(referrer_id, cursor_id=None, backward=False, limit=REFERRALS_PAGE):
+    """Приглашённые пользователем, новые сверху, по ключу id в индексе idx_users_referrer;
+    возвращает ([(id, username, rewarded, joined_at)], есть_ли_ещё)."""
+    if cursor_id is None:
+        rows = await storage.fetchall("""
+            SELECT id, username, rewarded, joined_at FROM users
+            WHERE referrer_id = ? ORDER BY id DESC LIMIT ?
+        """, (referrer_id, limit + 1))
+    elif backward:
+        rows = await storage.fetchall("""
+            SELECT id, username, rewarded, joined_at FROM users
+            WHERE referrer_id = ? AND id > ? ORDER BY id LIMIT ?
+        """, (referrer_id, cursor_id, limit + 1))
+    else:
+        rows = await storage.fetchall("""
+            SELECT id, username, rewarded, joined_at FROM users
+            WHERE referrer_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+        """, (referrer_id, cursor_id, limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+@metrics.timed("db_query_seconds")
+async def get_leaderboard(limit=10):
+    """[(user_id, username, рефералов)] из рейтинга в памяти; имена — из кэша пользователей."""
+    result = []
+    for user_id, score in leaderboard.top(limit):
+        # Без get_user: иначе каждый вызов рейтинга попадал бы в db_query_seconds дважды
+        user = await _get_user(user_id)
+        result.append((user_id, user.username if user else None, score))
+    return result
+
+
+@metrics.timed("db_query_seconds")
+async def compact_ledger():
+    """Переносит новые проводки в снимки balances; возвращает id последней учтённой проводки."""
+    async def op(conn):
+        async with conn.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM balances") as cur:
+            done = (await cur.fetchone())[0]
+        async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger") as cur:
+            last = (await cur.fetchone())[0]
+        if last > done:
+            await conn.execute("""
+                INSERT INTO balances (user_id, balance, held, referrals, ledger_id)
+                SELECT user_id,
+                       SUM(CASE WHEN account = 'balance' THEN amount ELSE 0 END),
+                       SUM(CASE WHEN account = 'held' THEN amount ELSE 0 END),
+                       SUM((kind = 'referral') - (kind = 'clawback')),
+                       :last
+                FROM ledger WHERE id > :done AND id <= :last
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    balance = balance + excluded.balance,
+                    held = held + excluded.held,
+                    referrals = referrals + excluded.referrals,
+                    ledger_id = excluded.ledger_id
+            """, {"done": done, "last": last})
+        return last
+    return await storage.submit(op)
+
+
+async def _compact_loop():
+    while True:
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+        try:
+            await compact_ledger()
+        except Exception:
+            logging.exception("Ledger compaction failed")
+
+
+@metrics.timed("db_query_seconds")
+async def reconcile_ledger():
+    """Сверка денег; возвращает список расхождений (пустой — всё сходится)."""
+    queries = (
+        ("ledger", "SELECT COALESCE(SUM(amount), 0) FROM ledger"),
+        ("stats", "SELECT COALESCE(SUM(value), 0) FROM stats WHERE key = 'balance_kop'"),
+        ("held", "SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE account = 'held'"),
+        ("pending", f"""
+            SELECT COALESCE(SUM(amount), 0) * {KOPECKS} FROM withdrawals WHERE status IN ('pending', 'held')
+        """),
+        # Снимки, не совпадающие с суммой проводок до своего ledger_id
+        ("drift", """
+            SELECT COUNT(*) FROM balances b
+            WHERE b.balance != (SELECT COALESCE(SUM(amount), 0) FROM ledger
+                                WHERE user_id = b.user_id AND account = 'balance' AND id <= b.ledger_id)
+               OR b.held != (SELECT COALESCE(SUM(amount), 0) FROM ledger
+                             WHERE user_id = b.user_id AND account = 'held' AND id <= b.ledger_id)
+        """),
+    )
+    totals = {}
+    async with storage.reader() as conn:
+        # Все проверки по одному снимку базы
+        await conn.execute("BEGIN")
+        try:
+            for name, sql in queries:
+                async with conn.execute(sql) as cur:
+                    totals[name] = (await cur.fetchone())[0]
+        finally:
+            await conn.execute("COMMIT")
+    problems = []
+    if totals["ledger"] != totals["stats"]:
+        problems.append(f"Сумма проводок {totals['ledger']} коп. ≠ счётчик balance_kop {totals['stats']} коп.")
+    if totals["held"] != totals["pending"]:
+        problems.append(f"Заморожено {totals['held']} коп. ≠ ожидающие заявки {totals['pending']} коп.")
+    if totals["drift"]:
+        problems.append(f"Снимков балансов, не совпадающих с проводками: {totals['drift']}")
+    return problems
+
+
+@metrics.timed("db_query_seconds")
+async def sync_users():
+    """Сбрасывает из кэша пользователей, которых изменили другие процессы."""
+    global _user_changes_seq, _user_changes_purged
+    rows = await storage.fetchall("""
+        SELECT seq, user_id FROM user_changes WHERE seq > ? AND pid != ? ORDER BY seq
+    """, (_user_changes_seq, os.getpid()))
+    if rows:
+        _user_changes_seq = rows[-1][0]
+        changed = {user_id for _, user_id in rows}
+        users.discard(changed)
+        # Рейтинг в кэше не сбросить — перечитываем счётчики изменённых
+        async with storage.reader() as conn:
+            for user_id in changed:
+                row = await _load_user(conn, user_id)
+                if row is not None:
+                    leaderboard.set(user_id, row[4])
+    now = time.time()
+    if now - _user_changes_purged > USER_CHANGES_TTL:
+        _user_changes_purged = now
+        await storage.execute("DELETE FROM user_changes WHERE changed_at < ?", (now - USER_CHANGES_TTL,))
+
+
+async def sync_shared(interval: float = SHARED_SYNC_INTERVAL):
+    """Фоновый цикл: настройки и кэш пользователей могли изменить другие воркеры или python -m importer."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_settings()
+            await sync_users()
+        except Exception:
+            logging.exception("Shared state sync failed")
+
+
+@metrics.timed("db_query_seconds")
+async def start_import(source):
+    """Отметка импорта из source: (last_id, imported, merged, finished_at); при первом запуске — новая."""
+    started = datetime.datetime.now().isoformat()
+    async def op(conn):
+        await conn.execute("INSERT OR IGNORE INTO imports (source, started_at) VALUES (?, ?)", (source, started))
+        async with conn.execute("""
+            SELECT last_id, imported, merged, finished_at FROM imports WHERE source = ?
+        """, (source,)) as cur:
+            return await cur.fetchone()
+    return await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def import_users(source, rows):
+    """Сливает пачку пользователей старой базы, отсортированную по id:
+    (id, username, referrer_id, rewarded, рефералов, баланс в копейках, joined_at).
+    Имеющиеся строки не затираются — к ним добавляются баланс и рефералы. Отметка импорта
+    сдвигается в той же транзакции, так что пачка учитывается ровно один раз.
+    Возвращает (новых, слитых с существующими) или None, если пачка уже учтена."""
+    first_id, last_id = rows[0][0], rows[-1][0]
+    async def op(conn):
+        async with conn.execute("SELECT last_id FROM imports WHERE source = ?", (source,)) as cur:
+            if (await cur.fetchone())[0] >= last_id:
+                return None
+        count = "SELECT COUNT(*) FROM users WHERE id BETWEEN ? AND ?"
+        async with conn.execute(count, (first_id, last_id)) as cur:
+            before = (await cur.fetchone())[0]
+        await conn.executemany("""
+            INSERT INTO users (id, username, referrer_id, rewarded, joined_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                username = COALESCE(username, excluded.username),
+                referrer_id = COALESCE(referrer_id, excluded.referrer_id),
+                rewarded = MAX(rewarded, excluded.rewarded)
+        """, [(user_id, username, referrer_id, rewarded, joined_at)
+              for user_id, username, referrer_id, rewarded, _, _, joined_at in rows])
+        async with conn.execute(count, (first_id, last_id)) as cur:
+            inserted = (await cur.fetchone())[0] - before
+        # Старые рефералы — в снимок (как при переходе на ledger), деньги — проводками import
+        await conn.executemany("""
+            INSERT INTO balances (user_id, referrals) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET referrals = referrals + excluded.referrals
+        """, [(row[0], row[4]) for row in rows if row[4] > 0])
+        entries = [(row[0], "import", "balance", row[5], None) for row in rows if row[5]]
+        if entries:
+            await _post(conn, entries)
+        await _log_user_changes(conn, [row[0] for row in rows if not row[5]])
+        if inserted:
+            await _track(conn, "signups", inserted, buckets=False)
+        await conn.execute("""
+            UPDATE imports SET last_id = ?, imported = imported + ?, merged = merged + ? WHERE source = ?
+        """, (last_id, inserted, len(rows) - inserted, source))
+        return inserted, len(rows) - inserted
+    result = await storage.submit(op)
+    if result is not None:
+        users.discard(row[0] for row in rows)
+    return result
+
+
+@metrics.timed("db_query_seconds")
+async def next_users_bound(after_id, limit):
+    """Последний id пачки из limit пользователей после after_id (None — их больше нет)."""
+    row = await storage.fetchone("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?", (after_id, limit - 1))
+    if row is None:
+        row = await storage.fetchone("SELECT MAX(id) FROM users WHERE id > ?", (after_id,))
+    return row[0]
+
+
+@metrics.timed("db_query_seconds")
+async def link_referrals(first_id, last_id, depth):
+    """Достраивает уровень depth дерева рефералов для пользователей с id в [first_id, last_id]."""
+    async def op(conn):
+        await _link_level(conn, depth, first_id, last_id)
+    await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def recount_downline(first_id, last_id):
+    """Пересчитывает размеры команд пользователей с id в [first_id, last_id] по дереву."""
+    async def op(conn):
+        async with conn.execute("""
+            INSERT INTO downline (user_id, size)
+            SELECT ancestor, COUNT(*) FROM referral_tree WHERE ancestor BETWEEN ? AND ? GROUP BY ancestor
+            ON CONFLICT (user_id) DO UPDATE SET size = excluded.size WHERE size != excluded.size
+            RETURNING user_id
+        """, (first_id, last_id)) as cur:
+            changed = [row[0] for row in await cur.fetchall()]
+        await _log_user_changes(conn, changed)
+        return changed
+    users.discard(await storage.submit(op))
+
+
+@metrics.timed("db_query_seconds")
+async def finish_import(source):
+    async def op(conn):
+        await conn.execute("UPDATE imports SET finished_at = ? WHERE source = ?",
+                           (datetime.datetime.now().isoformat(), source))
+    await storage.submit(op)
+    # Рейтинг собирается заново: за импорт поменялись счётчики тысяч пользователей
+    await _load_leaderboard()
+
+
+def _swap_settings(row):
+    global _settings
+    channel, enabled, throttle, version = row
+    # Более старая версия не должна затирать свежий снимок
+    if version >= _settings["version"]:
+        _settings = MappingProxyType({
+            "channel": channel,
+            # Несколько каналов хранятся в одной строке через пробел
+            "channels": tuple((channel or "").split()),
+            "enabled": bool(enabled),
+            "throttle": throttle or "",
+            "version": version,
+        })
+
+
+@metrics.timed("db_query_seconds")
+async def refresh_settings():
+    _swap_settings(await storage.fetchone(
+        "SELECT required_channel, check_subscription, throttle_limits, version FROM settings WHERE id = 1"))
+    return _settings
+
+
+async def get_settings():
+    return _settings
+
+
+@metrics.timed("db_query_seconds")
+async def settings_version():
+    """Версия настроек в базе — другие процессы сравнивают её со своим снимком."""
+    row = await storage.fetchone("SELECT version FROM settings WHERE id = 1")
+    return row[0]
+
+
+async def sync_settings():
+    """Перечитывает настройки, если другой процесс успел их изменить."""
+    if await settings_version() != _settings["version"]:
+        await refresh_settings()
+
+
+@metrics.timed("db_query_seconds")
+async def update_settings(channel, enabled):
+    async def op(conn):
+        async with conn.execute("""
+            UPDATE settings SET required_channel = ?, check_subscription = ?, version = version + 1
+            WHERE id = 1
+            RETURNING required_channel, check_subscription, throttle_limits, version
+        """, (channel, 1 if enabled else 0)) as cur:
+            return await cur.fetchone()
+    _swap_settings(await storage.submit(op))
+
+
+@metrics.timed("db_query_seconds")
+async def update_throttle_limits(limits):
+    async def op(conn):
+        async with conn.execute("""
+            UPDATE settings SET throttle_limits = ?, version = version + 1
+            WHERE id = 1
+            RETURNING required_channel, check_subscription, throttle_limits, version
+        """, (limits,)) as cur:
+            return await cur.fetchone()
+    _swap_settings(await storage.submit(op))
+
+
+@metrics.timed("db_query_seconds")
+async def add_withdrawal(user_id, amount):
+    """Заявка на вывод amount рублей с заморозкой суммы; None, если на балансе не хватает."""
     created = datetime.datetime.now().isoformat()
-    cur.execute("INSERT INTO withdrawals (user_id, amount, created_at) VALUES (?, ?, ?)",
-                (user_id, amount, created))
-    conn.commit()
-    conn.close()
-
-def get_pending_withdrawals():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT id, user_id, amount, created_at FROM withdrawals WHERE status='pending'")
-    rows = cur.fetchall()
-    conn.close()
+    async def op(conn):
+        # Баланс проверяется в той же транзакции, что и заморозка: двойное нажатие не выведет дважды
+        user = await _load_user(conn, user_id)
+        if user is None or user[3] < amount * KOPECKS:
+            return None
+        # Заявка пользователя под проверкой антифрода не попадает в очередь админа до решения по нему
+        async with conn.execute("""
+            INSERT INTO withdrawals (user_id, amount, created_at, status) VALUES (?, ?, ?, ?) RETURNING id
+        """, (user_id, amount, created, "pending" if user[10] is None else "held")) as cur:
+            withdrawal_id = (await cur.fetchone())[0]
+        await _post(conn, [(user_id, "hold", "balance", -amount * KOPECKS, withdrawal_id),
+                           (user_id, "hold", "held", amount * KOPECKS, withdrawal_id)])
+        await _track(conn, "withdrawals_requested")
+        await _track(conn, "withdrawals_requested_amount", amount)
+        return withdrawal_id, await _load_user(conn, user_id)
+    result = await storage.submit(op)
+    if result is None:
+        return None
+    withdrawal_id, row = result
+    users.put(row)
+    return withdrawal_id
+
+
+@metrics.timed("db_query_seconds")
+async def get_withdrawals_page(cursor_id=None, backward=False, limit=WITHDRAWALS_PAGE):
+    """Страница ожидающих заявок по ключу (created_at, id); возвращает (заявки, есть_ли_ещё)."""
+    if cursor_id is None:
+        rows = await storage.fetchall("""
+            SELECT id, user_id, amount, created_at FROM withdrawals
+            WHERE status = 'pending'
+            ORDER BY created_at, id LIMIT ?
+        """, (limit + 1,))
+    elif backward:
+        rows = await storage.fetchall("""
+            SELECT id, user_id, amount, created_at FROM withdrawals
+            WHERE status = 'pending'
+              AND (created_at, id) < (SELECT created_at, id FROM withdrawals WHERE id = ?)
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        """, (cursor_id, limit + 1))
+    else:
+        rows = await storage.fetchall("""
+            SELECT id, user_id, amount, created_at FROM withdrawals
+            WHERE status = 'pending'
+              AND (created_at, id) > (SELECT created_at, id FROM withdrawals WHERE id = ?)
+            ORDER BY created_at, id LIMIT ?
+        """, (cursor_id, limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+@metrics.timed("db_query_seconds")
+async def get_withdrawal(withdrawal_id):
+    """Ожидающая заявка по id или None, если её нет или она уже обработана."""
+    return await storage.fetchone("""
+        SELECT id, user_id, amount, created_at FROM withdrawals
+        WHERE id = ? AND status = 'pending'
+    """, (withdrawal_id,))
+
+
+@metrics.timed("db_query_seconds")
+async def resolve_withdrawal(withdrawal_id, status):
+    """Переводит ожидающую заявку в status: approved списывает замороженное, rejected возвращает его.
+
+    Возвращает (user_id, amount) или None, если заявку уже обработали.
+    """
+    async def op(conn):
+        async with conn.execute("""
+            UPDATE withdrawals SET status = ?
+            WHERE id = ? AND status = 'pending'
+            RETURNING user_id, amount
+        """, (status, withdrawal_id)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return None, None
+        await _post(conn, _settlement(withdrawal_id, row[0], row[1], status))
+        if status == "approved":
+            await _track_payouts(conn, 1, row[1])
+        return row, await _load_user(conn, row[0])
+    row, user = await storage.submit(op)
+    if user is not None:
+        users.put(user)
+    return row
+
+
+def _settlement(withdrawal_id, user_id, amount, status):
+    """Проводки закрытия заявки: выплата (payout) или возврат на баланс (release)."""
+    kopecks = amount * KOPECKS
+    if status == "approved":
+        return [(user_id, "payout", "held", -kopecks, withdrawal_id)]
+    return [(user_id, "release", "held", -kopecks, withdrawal_id),
+            (user_id, "release", "balance", kopecks, withdrawal_id)]
+
+
+async def _track_payouts(conn, count, amount):
+    await _track(conn, "withdrawals_paid", count)
+    await _track(conn, "withdrawals_paid_amount", amount)
+
+
+def _pending_filter(first_id=None, last_id=None, max_amount=None, created_before=None):
+    conditions, params = ["status = 'pending'"], []
+    if first_id is not None:
+        conditions.append("(created_at, id) >= (SELECT created_at, id FROM withdrawals WHERE id = ?)")
+        params.append(first_id)
+    if last_id is not None:
+        conditions.append("(created_at, id) <= (SELECT created_at, id FROM withdrawals WHERE id = ?)")
+        params.append(last_id)
+    if max_amount is not None:
+        conditions.append("amount <= ?")
+        params.append(max_amount)
+    if created_before is not None:
+        conditions.append("created_at <= ?")
+        params.append(created_before)
+    return " AND ".join(conditions), params
+
+
+@metrics.timed("db_query_seconds")
+async def summarize_withdrawals(**filters):
+    """Количество и сумма ожидающих заявок под фильтром — для предпросмотра массовой операции."""
+    where, params = _pending_filter(**filters)
+    row = await storage.fetchone(f"SELECT COUNT(*), SUM(amount) FROM withdrawals WHERE {where}", params)
+    return row[0], row[1] or 0
+
+
+@metrics.timed("db_query_seconds")
+async def resolve_withdrawals(status, **filters):
+    """Массово переводит ожидающие заявки в status одной транзакцией.
+
+    Фильтры: first_id/last_id (диапазон страницы), max_amount, created_before.
+    Возвращает [(id, user_id, amount)] обработанных заявок.
+    """
+    where, params = _pending_filter(**filters)
+    async def op(conn):
+        async with conn.execute(f"UPDATE withdrawals SET status = ? WHERE {where} RETURNING id, user_id, amount",
+                                [status] + params) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            return rows, []
+        entries = []
+        for withdrawal_id, user_id, amount in rows:
+            entries.extend(_settlement(withdrawal_id, user_id, amount, status))
+        await _post(conn, entries)
+        if status == "approved":
+            await _track_payouts(conn, len(rows), sum(amount for _, _, amount in rows))
+        # Свежие строки затронутых пользователей — для кэша
+        return rows, [await _load_user(conn, user_id) for user_id in {user_id for _, user_id, _ in rows}]
+    rows, changed = await storage.submit(op)
+    for row in changed:
+        users.put(row)
     return rows
 
-def update_withdrawal_status(withdrawal_id, status):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("UPDATE withdrawals SET status = ? WHERE id = ?", (status, withdrawal_id))
-    conn.commit()
-    conn.close()
-
-def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
-    conn.close()
-    return total
-
-def get_total_balance():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT SUM(balance) FROM users")
-    total = cur.fetchone()[0] or 0
-    conn.close()
-    return total
+
+@metrics.timed("db_query_seconds")
+async def create_broadcast(text, total):
+    created = datetime.datetime.now().isoformat()
+    async def op(conn):
+        async with conn.execute("INSERT INTO broadcasts (text, total, created_at) VALUES (?, ?, ?)",
+                                (text, total, created)) as cur:
+            return cur.lastrowid
+    return await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def get_broadcast(broadcast_id=None):
+    """Рассылка по id, а без id — последняя запущенная."""
+    columns = "id, text, status, last_user_id, total, sent, failed, blocked, created_at"
+    if broadcast_id is None:
+        return await storage.fetchone(f"SELECT {columns} FROM broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1")
+    return await storage.fetchone(f"SELECT {columns} FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+
+@metrics.timed("db_query_seconds")
+async def get_recipients(after_id, limit):
+    """Следующая порция получателей рассылки по первичному ключу, без заблокировавших бота."""
+    rows = await storage.fetchall("SELECT id FROM users WHERE id > ? AND blocked = 0 ORDER BY id LIMIT ?",
+                                  (after_id, limit))
+    return [row[0] for row in rows]
+
+
+@metrics.timed("db_query_seconds")
+async def checkpoint_broadcast(broadcast_id, last_user_id, sent, failed, blocked_ids, status="running"):
+    """Сохраняет прогресс рассылки и помечает заблокировавших бота — одной транзакцией."""
+    async def op(conn):
+        await conn.executemany("UPDATE users SET blocked = 1 WHERE id = ?", [(uid,) for uid in blocked_ids])
+        await _log_user_changes(conn, blocked_ids)
+        await conn.execute("""
+            UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?,
+                                  blocked = blocked + ?, status = ?
+            WHERE id = ?
+        """, (last_user_id, sent, failed, len(blocked_ids), status, broadcast_id))
+    await storage.submit(op)
+    users.discard(blocked_ids)
+
+
+@metrics.timed("db_query_seconds")
+async def set_broadcast_status(broadcast_id, status):
+    await storage.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+
+
+@metrics.timed("db_query_seconds")
+async def save_outbox(messages):
+    created = datetime.datetime.now().isoformat()
+    async def op(conn):
+        await conn.executemany("INSERT INTO outbox (chat_id, text, created_at) VALUES (?, ?, ?)",
+                               [(chat_id, text, created) for chat_id, text in messages])
+    await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def take_outbox():
+    """Забирает недоставленные сообщения из outbox, удаляя их из базы."""
+    async def op(conn):
+        async with conn.execute("DELETE FROM outbox RETURNING chat_id, text") as cur:
+            return await cur.fetchall()
+    return await storage.submit(op)
+
+
+@metrics.timed("db_query_seconds")
+async def export_users(after_id, limit=EXPORT_CHUNK):
+    """Пачка пользователей для CSV по ключу id: баланс, заморозка и рефералы — как в USER_SELECT,
+    хвост ledger берётся по индексу (user_id, id) только для пользователей пачки."""
+    return await storage.fetchall("""
+        SELECT u.id, u.username, u.referrer_id,
+               printf('%.2f', (COALESCE(b.balance, 0) + COALESCE(SUM(CASE WHEN l.account = 'balance' THEN l.amount END), 0)) / 100.0),
+               printf('%.2f', (COALESCE(b.held, 0) + COALESCE(SUM(CASE WHEN l.account = 'held' THEN l.amount END), 0)) / 100.0),
+               COALESCE(b.referrals, 0) + COALESCE(SUM((l.kind = 'referral') - (l.kind = 'clawback')), 0),
+               COALESCE(d.size, 0), u.rewarded, u.blocked, u.joined_at
+        FROM users u
+        LEFT JOIN balances b ON b.user_id = u.id
+        LEFT JOIN downline d ON d.user_id = u.id
+        LEFT JOIN ledger l ON l.user_id = u.id AND l.id > COALESCE(b.ledger_id, 0)
+        WHERE u.id > ?
+        GROUP BY u.id ORDER BY u.id LIMIT ?
+    """, (after_id, limit))
+
+
+@metrics.timed("db_query_seconds")
+async def export_withdrawals(after_id, limit=EXPORT_CHUNK):
+    return await storage.fetchall("""
+        SELECT id, user_id, amount, status, created_at FROM withdrawals
+        WHERE id > ? ORDER BY id LIMIT ?
+    """, (after_id, limit))
+
+
+@metrics.timed("db_query_seconds")
+async def get_stats():
+    return dict(await storage.fetchall("SELECT key, value FROM stats"))
+
+
+@metrics.timed("db_query_seconds")
+async def get_stats_buckets(period, since):
+    """Корзины period ('hour' или 'day') начиная с since: {metric: {bucket: value}}."""
+    rows = await storage.fetchall("""
+        SELECT bucket, metric, value FROM stats_buckets
+        WHERE period = ? AND bucket >= ?
+    """, (period, since))
+    result = {}
+    for bucket, metric, value in rows:
+        result.setdefault(metric, {})[bucket] = value
+    return result
+
+
+@metrics.timed("db_query_seconds")
+async def get_total_users():
+    row = await storage.fetchone("SELECT value FROM stats WHERE key = 'signups'")
+    return row[0] if row else 0
+
+
+@metrics.timed("db_query_seconds")
+async def get_total_balance():
+    """Сколько бот должен пользователям, в копейках."""
+    row = await storage.fetchone("SELECT value FROM stats WHERE key = 'balance_kop'")
+    return row[0] if row else 0
@@ -0,0 +1,74 @@
+import asyncio
+import csv
+import datetime
+import io
+import logging
+
+from aiogram import Bot
+from aiogram.types import InputFile
+
+import database as db
+import utils
+from notifier import notifier
+
+# Загрузка большого файла в Telegram идёт дольше обычного запроса
+EXPORT_TIMEOUT = 600
+
+EXPORTS = {
+    "users": (("id", "username", "referrer_id", "balance", "held", "referrals", "team", "rewarded", "blocked",
+               "joined_at"), db.export_users),
+    "withdrawals": (("id", "user_id", "amount", "status", "created_at"), db.export_withdrawals),
+}
+
+_tasks = set()
+
+
+class CsvExport(InputFile):
+    """CSV-документ, который пишется по ходу загрузки: строки читаются пачками по ключу id
+    и сразу уходят в запрос, так что в памяти не больше одной пачки."""
+
+    def __init__(self, name: str, chunk: int = db.EXPORT_CHUNK):
+        super().__init__(filename=f"{name}-{datetime.date.today():%Y%m%d}.csv")
+        self.header, self.fetch = EXPORTS[name]
+        self.chunk = chunk
+        self.rows = 0
+
+    async def read(self, bot: Bot):
+        # Повторная отправка (после 429) начинает файл заново
+        self.rows = 0
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM — чтобы Excel открыл кириллицу в UTF-8
+        buffer.write("\ufeff")
+        writer.writerow(self.header)
+        after_id = 0
+        while True:
+            rows = await self.fetch(after_id, self.chunk)
+            writer.writerows(rows)
+            self.rows += len(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            if len(rows) < self.chunk:
+                return
+            after_id = rows[-1][0]
+
+
+def start(bot: Bot, chat_id: int, name: str):
+    """Отправляет выгрузку name в chat_id фоном, не задерживая обработку обновлений."""
+
+    async def job():
+        document = CsvExport(name)
+        try:
+            await utils.call_api(bot.send_document, chat_id=chat_id, document=document,
+                                 caption=f"📄 Выгрузка {name} на {datetime.datetime.now():%d.%m.%Y %H:%M}",
+                                 request_timeout=EXPORT_TIMEOUT)
+        except Exception as e:
+            logging.exception("Export of %s failed", name)
+            notifier.send(chat_id, f"❌ Выгрузка {name} не удалась: {e}")
+        else:
+            logging.info("Exported %d rows of %s", document.rows, name)
+
+    task = asyncio.create_task(job())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -0,0 +1,189 @@
+import logging
+import time
+from collections import OrderedDict
+
+import database as db
+import metrics
+from config import ADMIN_ID
+from notifier import notifier
+
+# Пороги на одного реферера; срабатывание любого ставит его на проверку
+SIGNUPS_PER_MINUTE = 20
+SIGNUPS_PER_HOUR = 150
+# Доли считаются, только когда за час набралось столько регистраций
+MIN_SAMPLE = 30
+MAX_ANONYMOUS = 0.9  # без username
+MAX_REPEATED = 0.6  # имя по уже встречавшемуся шаблону: user123, user124, …
+MIN_PASSED = 0.1  # прошли проверку подписки
+# Приглашённые последних минут ещё могут подписаться — в долю прошедших их не считаем
+PASS_GRACE = 300
+MAX_REFERRERS = 50_000
+# Сколько шаблонов имён помнить на реферера (частые шаблоны вытесняют редкие)
+NAME_SLOTS = 8
+EVICT_BATCH = 4
+# Индексы счётчиков часового окна
+SIGNUPS, ANONYMOUS, REPEATED, PASSED = range(4)
+
+# «Alex_2024» и «alex_1999» — один шаблон
+_DIGITS = str.maketrans("0123456789", "##########")
+
+
+def name_pattern(user) -> str:
+    return (user.first_name or "").lower().translate(_DIGITS)
+
+
+class Window:
+    """Скользящее окно из двух корзин: текущая плюс остаток предыдущей пропорционально времени.
+    Память — пара чисел на счётчик, погрешность — не больше неравномерности внутри одной корзины."""
+
+    __slots__ = ("size", "start", "current", "previous")
+
+    def __init__(self, size: float, counters: int, now: float):
+        self.size = size
+        self.start = now
+        self.current = [0] * counters
+        self.previous = [0] * counters
+
+    def _rotate(self, now: float):
+        elapsed = now - self.start
+        if elapsed >= self.size:
+            # Через две корзины и больше от прежней текущей в окне уже ничего не осталось
+            self.previous = self.current if elapsed < 2 * self.size else [0] * len(self.current)
+            self.current = [0] * len(self.current)
+            self.start = now - elapsed % self.size
+
+    def add(self, counter: int, now: float):
+        self._rotate(now)
+        self.current[counter] += 1
+
+    def value(self, counter: int, now: float) -> float:
+        self._rotate(now)
+        return self.current[counter] + self.previous[counter] * (1 - (now - self.start) / self.size)
+
+
+class ReferrerStats:
+    __slots__ = ("minute", "recent", "hour", "names", "updated", "flagged")
+
+    def __init__(self, now: float):
+        self.minute = Window(60, 1, now)
+        self.recent = Window(PASS_GRACE, 1, now)
+        self.hour = Window(3600, 4, now)
+        self.names = {}
+        self.updated = now
+        self.flagged = False
+
+
+class Detector:
+    """Потоковый детектор накрутки рефералов: скользящие счётчики по рефереру в ограниченном LRU.
+
+    На каждую регистрацию — несколько сложений и сравнений, без запросов к базе;
+    база затрагивается только в момент, когда реферер впервые становится подозрительным.
+    """
+
+    def __init__(self, size: int = MAX_REFERRERS):
+        self.size = size
+        self.per_minute = SIGNUPS_PER_MINUTE
+        self.per_hour = SIGNUPS_PER_HOUR
+        self.min_sample = MIN_SAMPLE
+        self._stats = OrderedDict()
+
+    def shard(self, total: int):
+        # Обновления приглашённых делятся между воркерами по id — каждый видит 1/total потока реферера
+        self.per_minute /= total
+        self.per_hour /= total
+        self.min_sample /= total
+
+    def _get(self, referrer_id: int, now: float) -> ReferrerStats:
+        stats = self._stats.get(referrer_id)
+        if stats is None:
+            stats = self._stats[referrer_id] = ReferrerStats(now)
+        else:
+            self._stats.move_to_end(referrer_id)
+        stats.updated = now
+        # Реферер, молчавший больше часа, ничем не отличается от нового
+        for _ in range(EVICT_BATCH):
+            key, oldest = next(iter(self._stats.items()))
+            if now - oldest.updated < 3600 and len(self._stats) <= self.size:
+                break
+            del self._stats[key]
+        return stats
+
+    def _remember_name(self, stats: ReferrerStats, pattern: str) -> bool:
+        """Учитывает шаблон имени (Misra–Gries на NAME_SLOTS); True — шаблон уже встречался."""
+        names = stats.names
+        if pattern in names:
+            names[pattern] += 1
+            return True
+        if len(names) < NAME_SLOTS:
+            names[pattern] = 1
+        else:
+            for key in list(names):
+                names[key] -= 1
+                if not names[key]:
+                    del names[key]
+        return False
+
+    def _check(self, stats: ReferrerStats, now: float):
+        per_minute = stats.minute.value(0, now)
+        if per_minute > self.per_minute:
+            return f"{per_minute:.0f} регистраций за минуту"
+        hour = stats.hour
+        signups = hour.value(SIGNUPS, now)
+        if signups > self.per_hour:
+            return f"{signups:.0f} регистраций за час"
+        if signups < self.min_sample:
+            return None
+        for counter, limit, text in ((ANONYMOUS, MAX_ANONYMOUS, "без username"),
+                                     (REPEATED, MAX_REPEATED, "одинаковые имена")):
+            share = hour.value(counter, now) / signups
+            if share > limit:
+                return f"{text}: {share:.0%} регистраций за час"
+        settled = signups - stats.recent.value(0, now)
+        if settled >= self.min_sample:
+            share = hour.value(PASSED, now) / settled
+            if share < MIN_PASSED:
+                return f"прошли проверку подписки: {share:.0%} регистраций за час"
+        return None
+
+    def observe_signup(self, referrer_id: int, user):
+        """Новый приглашённый; возвращает причину, если реферер только что стал подозрительным."""
+        now = time.monotonic()
+        stats = self._get(referrer_id, now)
+        stats.minute.add(0, now)
+        stats.recent.add(0, now)
+        stats.hour.add(SIGNUPS, now)
+        if not user.username:
+            stats.hour.add(ANONYMOUS, now)
+        if self._remember_name(stats, name_pattern(user)):
+            stats.hour.add(REPEATED, now)
+        if stats.flagged:
+            return None
+        reason = self._check(stats, now)
+        stats.flagged = reason is not None
+        return reason
+
+    def observe_pass(self, referrer_id: int):
+        """Приглашённый прошёл проверку подписки."""
+        stats = self._stats.get(referrer_id)
+        if stats is not None:
+            stats.hour.add(PASSED, time.monotonic())
+
+    def forget(self, referrer_id: int):
+        # Админ снял проверку — счёт начинается заново
+        self._stats.pop(referrer_id, None)
+
+    def __len__(self):
+        return len(self._stats)
+
+
+detector = Detector()
+metrics.registry.collect("fraud_tracked_referrers", lambda: len(detector))
+
+
+async def flag(referrer_id: int, reason: str):
+    """Ставит реферера на проверку: новые бонусы за его приглашённых и его выводы ждут решения админа."""
+    metrics.registry.inc("fraud_flags_total")
+    if await db.flag_referrer(referrer_id, reason):
+        logging.warning("Referrer %s held: %s", referrer_id, reason)
+        notifier.send(ADMIN_ID, f"⚠️ Реферер {referrer_id} поставлен на проверку: {reason}.\n"
+                                f"Бонусы за его приглашённых и его выводы задержаны — /holds")
@@ -0,0 +1,101 @@
+import contextlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import database as db
+import priority
+from config import ADMIN_ID
+
+# Состояние диалога, не тронутое сутки, считается брошенным
+FSM_TTL = 24 * 3600
+FSM_CACHE_SIZE = 10_000
+FSM_CACHE_TTL = 5
+PURGE_INTERVAL = 600
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в базе бота: переживает перезапуск и общее для нескольких процессов."""
+
+    def __init__(self, ttl: float = FSM_TTL, cache_size: int = FSM_CACHE_SIZE,
+                 cache_ttl: float = FSM_CACHE_TTL):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()   # key -> (когда прочитано, state, data)
+        self._next_purge = 0.0
+
+    @staticmethod
+    def _prioritized(key: StorageKey):
+        # Состояние читается до роутинга и планировщика, класс хендлера ещё неизвестен;
+        # админа видно по ключу — его запросы встают в очереди к базе первыми
+        if key.user_id == ADMIN_ID:
+            return db.prioritized(priority.CLASSES.index(priority.ADMIN))
+        return contextlib.nullcontext()
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        self._cache[key] = (time.monotonic(), state, data)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str):
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            return entry[1], entry[2]
+        row = await db.storage.fetchone(
+            "SELECT state, data FROM fsm WHERE key = ? AND expires_at > ?", (key, time.time()))
+        state, data = (row[0], json.loads(row[1])) if row else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    async def _write(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        now = time.time()
+        purge = now >= self._next_purge
+        if purge:
+            self._next_purge = now + PURGE_INTERVAL
+
+        async def op(conn):
+            if state is None and not data:
+                await conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            else:
+                await conn.execute("""
+                    INSERT INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET
+                        state = excluded.state, data = excluded.data, expires_at = excluded.expires_at
+                """, (key, state, json.dumps(data, ensure_ascii=False), now + self.ttl))
+            if purge:
+                await conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+        await db.storage.submit(op)
+        self._remember(key, state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        built = self.key_builder.build(key)
+        with self._prioritized(key):
+            _, data = await self._load(built)
+            await self._write(built, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        with self._prioritized(key):
+            state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        built = self.key_builder.build(key)
+        with self._prioritized(key):
+            state, _ = await self._load(built)
+            await self._write(built, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        with self._prioritized(key):
+            _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        self._cache.clear()
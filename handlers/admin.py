@@ -1,20 +1,60 @@
+import asyncio
+import datetime
+import os
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.exceptions import TelegramBadRequest
 import database as db
-from keyboards import admin_menu_keyboard, settings_keyboard, withdrawals_keyboard, withdrawal_action_keyboard
+import metrics
+import utils
+from keyboards import admin_menu_keyboard, settings_keyboard, withdrawals_keyboard, withdrawal_action_keyboard, \
+    bulk_confirm_keyboard, broadcast_keyboard, metrics_keyboard, holds_keyboard
+from broadcast import broadcaster
+import throttling
+import fraud
+import priority
+import importer
+import export
+from backup import backups
 from config import ADMIN_ID
+from notifier import notifier
+from handlers.start import credit_referrer
 
 router = Router()
 
 class AdminStates(StatesGroup):
     waiting_for_channel = State()
+    waiting_for_bulk_filter = State()
+    waiting_for_broadcast = State()
+    waiting_for_throttle = State()
 
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
 
+def notify_resolved(user_id: int, amount, status: str):
+    if status == "approved":
+        notifier.send(user_id, f"✅ Ваша заявка на вывод {amount} руб. одобрена!")
+    else:
+        notifier.send(user_id, f"❌ Ваша заявка на вывод {amount} руб. отклонена администратором.")
+
+def format_limits(limits: dict) -> str:
+    return " ".join(f"{action}={burst}/{period:g}" for action, (burst, period) in limits.items())
+
+def holds_text(holds) -> str:
+    if not holds:
+        return "✅ На проверке антифрода никого нет."
+    text = "⏸ <b>На проверке антифрода</b>\n\n"
+    for user_id, username, reason, rewards, count, amount in holds:
+        text += f"• {'@' + username if username else user_id} (ID: {user_id}): {reason}\n" \
+                f"  отложено бонусов: {rewards}, задержано заявок: {count} на {amount} руб.\n"
+    return text + "\n«Снять» начисляет отложенные бонусы и возвращает заявки в очередь, «Отклонить» отменяет их."
+
+def days_ago(days: int) -> str:
+    return (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
+
 @router.message(Command("admin"))
 async def admin_panel(message: Message):
     if not is_admin(message.from_user.id):
@@ -27,10 +67,11 @@ async def admin_settings(callback: CallbackQuery):
         await callback.answer("Нет доступа")
         return
     
-    settings = db.get_settings()
+    settings = await db.get_settings()
     text = "⚙️ Настройки бота:\n\n" \
-           f"📢 Канал: @{settings['channel'] if settings['channel'] else 'не указан'}\n" \
-           f"✅ Проверка подписки: {'включена' if settings['enabled'] else 'выключена'}"
+           f"📢 Каналы: {' '.join('@' + ch for ch in settings['channels']) or 'не указаны'}\n" \
+           f"✅ Проверка подписки: {'включена' if settings['enabled'] else 'выключена'}\n" \
+           f"⏱ Антифлуд (нажатий/секунд): {format_limits(throttling.throttler.limits(settings))}"
     
     await callback.message.edit_text(text, reply_markup=settings_keyboard(settings['enabled'], settings['channel']))
 
@@ -39,9 +80,9 @@ async def toggle_sub_check(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    settings = db.get_settings()
+    settings = await db.get_settings()
     new_enabled = not settings['enabled']
-    db.update_settings(settings['channel'], new_enabled)
+    await db.update_settings(settings['channel'], new_enabled)
     await callback.answer(f"Проверка подписки {'включена' if new_enabled else 'выключена'}")
     await admin_settings(callback)
 
@@ -50,7 +91,7 @@ async def set_channel(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         return
     
-    await callback.message.edit_text("📝 Введите username канала (без @):")
+    await callback.message.edit_text("📝 Введите username каналов через пробел (без @):")
     await state.set_state(AdminStates.waiting_for_channel)
 
 @router.message(AdminStates.waiting_for_channel)
@@ -58,38 +99,217 @@ async def receive_channel(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         return
     
-    channel = message.text.strip().replace("@", "")
-    settings = db.get_settings()
-    db.update_settings(channel, settings['enabled'])
-    await message.answer(f"✅ Канал установлен: @{channel}")
+    channels = utils.parse_channels(message.text)
+    settings = await db.get_settings()
+    await db.update_settings(" ".join(channels), settings['enabled'])
+    await message.answer(f"✅ Каналы установлены: {' '.join('@' + ch for ch in channels) or 'нет'}")
     await state.clear()
     await message.answer("👨‍💻 Админ-панель", reply_markup=admin_menu_keyboard())
 
+@router.callback_query(F.data == "set_throttle")
+async def set_throttle(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    current = format_limits(throttling.throttler.limits(await db.get_settings()))
+    await callback.message.edit_text(
+        "⏱ Введите лимиты в виде действие=нажатий/секунд через пробел, например:\n"
+        f"<code>{current}</code>\n\n"
+        f"Действия: {', '.join(throttling.DEFAULT_LIMITS)}. Не указанные остаются по умолчанию.",
+        parse_mode="HTML"
+    )
+    await state.set_state(AdminStates.waiting_for_throttle)
+
+@router.message(AdminStates.waiting_for_throttle)
+async def receive_throttle(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
+    try:
+        limits = utils.parse_limits(message.text)
+        unknown = set(limits) - set(throttling.DEFAULT_LIMITS)
+        if unknown:
+            raise ValueError(f"Unknown actions: {unknown}")
+    except ValueError:
+        await message.answer("❌ Неверный формат. Пример: profile=5/10 check_sub=3/10")
+        return
+    await db.update_throttle_limits(format_limits(limits))
+    await message.answer(f"✅ Лимиты сохранены: {format_limits(throttling.throttler.limits(await db.get_settings()))}")
+    await state.clear()
+    await message.answer("👨‍💻 Админ-панель", reply_markup=admin_menu_keyboard())
+
+STAT_LINES = (
+    ("signups", "🆕 Регистрации"),
+    ("referral_credits", "🔗 Засчитано рефералов"),
+    ("referral_holds", "⏸ Бонусов отложено антифродом"),
+    ("fraud_flags", "⚠️ Рефереров поставлено на проверку"),
+    ("referral_clawbacks", "➖ Отозвано рефералов (отписались)"),
+    ("withdrawals_requested", "📝 Заявок на вывод"),
+    ("withdrawals_paid_amount", "💸 Выплачено, руб."),
+    ("gate_shown", "📢 Показов проверки подписки"),
+    ("gate_passed", "✅ Прошли проверку подписки"),
+)
+
 @router.callback_query(F.data == "admin_stats")
 async def admin_stats(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    total_users = db.get_total_users()
-    total_balance = db.get_total_balance()
+    # Все цифры заранее посчитаны на путях записи — здесь только чтение счётчиков
+    totals = await db.get_stats()
+    now = datetime.datetime.now()
+    hours = await db.get_stats_buckets("hour", (now - datetime.timedelta(hours=23)).strftime("%Y-%m-%dT%H"))
+    days = await db.get_stats_buckets("day", (now - datetime.timedelta(days=6)).strftime("%Y-%m-%d"))
     
     text = f"📊 <b>Статистика</b>\n\n" \
-           f"👥 Всего пользователей: {total_users}\n" \
-           f"💰 Общий баланс: {total_balance} руб."
+           f"👥 Всего пользователей: {totals.get('signups', 0)}\n" \
+           f"💰 Общий баланс: {utils.format_rub(totals.get('balance_kop', 0))} руб.\n" \
+           f"🔗 Начислено за рефералов: {utils.format_rub(totals.get('referral_kop', 0))} руб.\n" \
+           f"💸 Выплачено: {totals.get('withdrawals_paid_amount', 0)} руб.\n\n" \
+           f"<b>24 часа / 7 дней</b>\n"
+    for metric, title in STAT_LINES:
+        text += f"{title}: {sum(hours.get(metric, {}).values())} / {sum(days.get(metric, {}).values())}\n"
+    
+    shown = sum(days.get("gate_shown", {}).values())
+    if shown:
+        text += f"📈 Конверсия подписки за 7 дней: {sum(days.get('gate_passed', {}).values()) * 100 // shown}%\n"
+    trend = [str(days.get("signups", {}).get((now - datetime.timedelta(days=i)).strftime("%Y-%m-%d"), 0))
+             for i in range(6, -1, -1)]
+    text += f"\n🗓 Регистрации по дням: {' · '.join(trend)}"
+    
+    leaders = await db.get_downline_leaders(5)
+    if leaders:
+        text += "\n\n<b>Самые большие команды</b>\n"
+        for user_id, username, size in leaders:
+            text += f"• {'@' + username if username else user_id}: {size}\n"
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=admin_menu_keyboard())
 
+@router.message(Command("reconcile"))
+async def reconcile(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    problems = await db.reconcile_ledger()
+    if problems:
+        await message.answer("⚠️ Сверка денег не сошлась:\n" + "\n".join(f"• {p}" for p in problems))
+    else:
+        await message.answer("✅ Сверка денег сходится: проводки, счётчики, заморозки и снимки балансов.")
+
+@router.message(Command("import"))
+async def import_legacy(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+    
+    path = (command.args or "").strip() or "refer_bot.db"
+    if not os.path.isfile(path):
+        await message.answer(f"❌ Файл {path} не найден. Использование: /import путь/к/refer_bot.db")
+        return
+    if importer.running():
+        await message.answer("⏳ Импорт уже идёт.")
+        return
+    
+    importer.start(path, lambda text: notifier.send(ADMIN_ID, text))
+    await message.answer(f"⏳ Импорт {path} запущен. Бот продолжает работать, итог придёт сообщением.")
+
+@router.message(Command("export"))
+async def export_csv(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+    
+    name = (command.args or "").strip()
+    if name not in export.EXPORTS:
+        await message.answer("Использование: /export " + " или /export ".join(export.EXPORTS))
+        return
+    
+    export.start(message.bot, message.chat.id, name)
+    await message.answer(f"⏳ Готовлю выгрузку {name}, файл придёт отдельным сообщением.")
+
+@router.message(Command("backup"))
+async def backup_now(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    if backups.running:
+        await message.answer("⏳ Копия базы уже создаётся.")
+        return
+    backups.launch(lambda text: notifier.send(ADMIN_ID, text))
+    await message.answer("⏳ Создаю копию базы, бот продолжает работать.")
+
+@router.message(Command("holds"))
+async def show_holds(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    holds = await db.get_held_referrers()
+    await message.answer(holds_text(holds), parse_mode="HTML", reply_markup=holds_keyboard(holds))
+
+@router.callback_query(F.data.startswith("hold_release_"))
+async def release_hold(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    user_id = int(callback.data.split("_")[2])
+    released = await db.release_referrer(user_id)
+    if released is None:
+        await callback.answer("Проверка уже снята.")
+        return
+    
+    invitees, withdrawals = released
+    fraud.detector.forget(user_id)
+    # Параллельные начисления уходят в базу пачками через групповой коммит
+    await asyncio.gather(*(credit_referrer(user_id, invitee_id) for invitee_id in invitees))
+    await callback.answer(f"✅ Начислено бонусов: {len(invitees)}, заявок возвращено в очередь: {withdrawals}",
+                          show_alert=True)
+    
+    holds = await db.get_held_referrers()
+    await callback.message.edit_text(holds_text(holds), parse_mode="HTML", reply_markup=holds_keyboard(holds))
+
+@router.callback_query(F.data.startswith("hold_reject_"))
+async def reject_hold(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    user_id = int(callback.data.split("_")[2])
+    rewards, withdrawals = await db.reject_referrer(user_id)
+    for _, amount in withdrawals:
+        notify_resolved(user_id, amount, "rejected")
+    await callback.answer(f"❌ Отменено бонусов: {rewards}, отклонено заявок: {len(withdrawals)}", show_alert=True)
+    
+    holds = await db.get_held_referrers()
+    try:
+        await callback.message.edit_text(holds_text(holds), parse_mode="HTML", reply_markup=holds_keyboard(holds))
+    except TelegramBadRequest:
+        pass  # повторное нажатие: список не изменился
+
 @router.callback_query(F.data == "admin_withdrawals")
 async def admin_withdrawals(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    withdrawals = db.get_pending_withdrawals()
+    withdrawals, has_next = await db.get_withdrawals_page()
     if not withdrawals:
         await callback.message.edit_text("📭 Нет ожидающих заявок.", reply_markup=admin_menu_keyboard())
         return
     
-    await callback.message.edit_text("💰 Ожидающие заявки на вывод:", reply_markup=withdrawals_keyboard(withdrawals))
+    await callback.message.edit_text("💰 Ожидающие заявки на вывод:",
+                                     reply_markup=withdrawals_keyboard(withdrawals, False, has_next))
+
+@router.callback_query(F.data.startswith("wpage_"))
+async def withdrawals_page(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    _, direction, cursor_id = callback.data.split("_")
+    backward = direction == "prev"
+    withdrawals, has_more = await db.get_withdrawals_page(int(cursor_id), backward)
+    if not withdrawals:
+        await admin_withdrawals(callback)
+        return
+    
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    await callback.message.edit_text("💰 Ожидающие заявки на вывод:",
+                                     reply_markup=withdrawals_keyboard(withdrawals, has_prev, has_next))
 
 @router.callback_query(F.data.startswith("withdraw_"))
 async def process_withdrawal(callback: CallbackQuery):
@@ -97,8 +317,7 @@ async def process_withdrawal(callback: CallbackQuery):
         return
     
     w_id = int(callback.data.split("_")[1])
-    withdrawals = db.get_pending_withdrawals()
-    withdrawal = next((w for w in withdrawals if w[0] == w_id), None)
+    withdrawal = await db.get_withdrawal(w_id)
     
     if not withdrawal:
         await callback.answer("❌ Заявка уже обработана.")
@@ -119,22 +338,16 @@ async def approve_withdrawal(callback: CallbackQuery):
         return
     
     w_id = int(callback.data.split("_")[1])
-    withdrawals = db.get_pending_withdrawals()
-    withdrawal = next((w for w in withdrawals if w[0] == w_id), None)
+    withdrawal = await db.resolve_withdrawal(w_id, "approved")
     
     if not withdrawal:
         await callback.answer("❌ Заявка уже обработана.")
         return
     
-    _, user_id, amount, _ = withdrawal
-    db.update_withdrawal_status(w_id, "approved")
-    db.update_user_balance(user_id, -amount)
+    user_id, amount = withdrawal
     await callback.answer("✅ Заявка одобрена")
     
-    try:
-        await callback.bot.send_message(user_id, f"✅ Ваша заявка на вывод {amount} руб. одобрена!")
-    except:
-        pass
+    notify_resolved(user_id, amount, "approved")
     
     await admin_withdrawals(callback)
 
@@ -144,24 +357,163 @@ async def reject_withdrawal(callback: CallbackQuery):
         return
     
     w_id = int(callback.data.split("_")[1])
-    withdrawals = db.get_pending_withdrawals()
-    withdrawal = next((w for w in withdrawals if w[0] == w_id), None)
+    withdrawal = await db.resolve_withdrawal(w_id, "rejected")
     
     if not withdrawal:
         await callback.answer("❌ Заявка уже обработана.")
         return
     
-    _, user_id, amount, _ = withdrawal
-    db.update_withdrawal_status(w_id, "rejected")
+    user_id, amount = withdrawal
     await callback.answer("❌ Заявка отклонена")
     
+    notify_resolved(user_id, amount, "rejected")
+    
+    await admin_withdrawals(callback)
+
+@router.callback_query(F.data == "wbulk_filter")
+async def bulk_filter(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    await callback.message.edit_text("🧮 Введите максимальную сумму заявки и её минимальный возраст в днях "
+                                     "через пробел, например: 1000 7")
+    await state.set_state(AdminStates.waiting_for_bulk_filter)
+
+@router.message(AdminStates.waiting_for_bulk_filter)
+async def receive_bulk_filter(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
     try:
-        await callback.bot.send_message(user_id, f"❌ Ваша заявка на вывод {amount} руб. отклонена администратором.")
-    except:
-        pass
+        max_amount, days = map(int, message.text.split())
+    except ValueError:
+        await message.answer("❌ Нужно два числа: сумма и количество дней, например: 1000 7")
+        return
+    await state.clear()
+    
+    count, total = await db.summarize_withdrawals(max_amount=max_amount, created_before=days_ago(days))
+    text = f"🧮 Заявок до {max_amount} руб. старше {days} дн.: {count}\n" \
+           f"💰 На сумму: {total} руб."
+    await message.answer(text, reply_markup=bulk_confirm_keyboard(max_amount, days))
+
+@router.callback_query(F.data.startswith("wbulk_"))
+async def bulk_resolve(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    _, status, mode, a, b = callback.data.split("_")
+    if status not in ("approved", "rejected"):
+        return
+    if mode == "page":
+        filters = {"first_id": int(a), "last_id": int(b)}
+    else:
+        filters = {"max_amount": int(a), "created_before": days_ago(int(b))}
+    
+    # Статусы и списания — одной транзакцией, уведомления уходят в очередь пачкой
+    resolved = await db.resolve_withdrawals(status, **filters)
+    for _, user_id, amount in resolved:
+        notify_resolved(user_id, amount, status)
+    await callback.answer(f"Обработано заявок: {len(resolved)}", show_alert=True)
     
     await admin_withdrawals(callback)
 
+def broadcast_status_text(row) -> str:
+    b_id, _, status, _, total, sent, failed, blocked, created = row
+    done = sent + failed + blocked
+    text = f"📣 Рассылка #{b_id} от {created[:16].replace('T', ' ')}\n\n" \
+           f"📬 Доставлено: {sent} из ~{total}\n" \
+           f"⚠️ Ошибок: {failed}, заблокировали бота: {blocked}\n"
+    if status == "running":
+        rate = broadcaster.throughput() if broadcaster.broadcast_id == b_id else 0
+        text += f"⚡️ Скорость: {rate:.1f} сообщ./с\n"
+        if rate:
+            eta = max(total - done, 0) / rate
+            text += f"⏳ Осталось примерно: {int(eta // 3600)} ч {int(eta % 3600 // 60)} мин"
+    else:
+        text += {"done": "✅ Завершена", "cancelled": "⏹ Остановлена"}.get(status, status)
+    return text
+
+@router.callback_query(F.data == "admin_broadcast")
+async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    row = await db.get_broadcast(broadcaster.broadcast_id) if broadcaster.broadcast_id else await db.get_broadcast()
+    if row and row[2] == "running":
+        await callback.message.edit_text(broadcast_status_text(row), reply_markup=broadcast_keyboard(True))
+        return
+    
+    await callback.message.edit_text("📣 Отправьте текст рассылки. Он уйдёт всем пользователям бота.")
+    await state.set_state(AdminStates.waiting_for_broadcast)
+
+@router.message(AdminStates.waiting_for_broadcast)
+async def receive_broadcast(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
+    await state.clear()
+    if broadcaster.running:
+        await message.answer("❌ Рассылка уже идёт.", reply_markup=admin_menu_keyboard())
+        return
+    b_id = await broadcaster.start(message.bot, message.html_text)
+    await message.answer(broadcast_status_text(await db.get_broadcast(b_id)), reply_markup=broadcast_keyboard(True))
+
+@router.callback_query(F.data == "broadcast_cancel")
+async def broadcast_cancel(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    await callback.answer("⏹ Останавливаем рассылку…")
+    await broadcaster.cancel()
+    row = await db.get_broadcast(broadcaster.broadcast_id)
+    await callback.message.edit_text(broadcast_status_text(row), reply_markup=broadcast_keyboard(False))
+
+METRIC_TOP = 5
+
+def ms(seconds: float) -> str:
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:g}"
+
+def metric_lines(name: str, label: str, limit: int = METRIC_TOP) -> str:
+    # Верхние границы корзин гистограмм, поэтому p50/p95 — оценка «не больше»
+    return "".join(f"• {value}: {count} шт., p50≤{ms(p50)} / p95≤{ms(p95)} мс\n"
+                   for value, count, p50, p95, _ in metrics.registry.summary(name, label)[:limit])
+
+def priority_lines() -> str:
+    scheduler = priority.scheduler
+    lines = ""
+    for name in priority.CLASSES:
+        wait = metrics.registry.histogram("scheduler_wait_seconds", priority=name)
+        shed = sum(value for (metric, labels), value in metrics.registry.counters.items()
+                   if metric == "scheduler_shed_total" and dict(labels)["priority"] == name)
+        lines += f"• {name}: выполняется {scheduler.running[name]}/{scheduler.limits[name]}, " \
+                 f"ждут {scheduler.queued[name]}, ожидание p95≤{ms(wait.quantile(.95))} мс"
+        lines += f", сброшено {shed:g}\n" if shed else "\n"
+    return lines
+
+@router.callback_query(F.data == "admin_metrics")
+async def admin_metrics(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    registry = metrics.registry
+    errors = sum(v for (name, _), v in registry.counters.items() if name == "bot_api_errors_total")
+    writer_wait = registry.histogram("db_writer_wait_seconds")
+    text = "📈 <b>Метрики с запуска процесса</b>\n\n" \
+           f"⏳ В обработке: {registry.value('bot_updates_in_flight'):g} обновлений\n" \
+           f"📬 Очередь уведомлений: {notifier.queued}\n\n" \
+           f"<b>Очереди по приоритету</b>\n{priority_lines()}\n" \
+           f"<b>Обновления</b>\n{metric_lines('bot_update_seconds', 'type')}\n" \
+           f"<b>Хендлеры (по суммарному времени)</b>\n{metric_lines('bot_handler_seconds', 'handler')}\n" \
+           f"<b>БД</b> — коммитов: {db.storage.commits}\n{metric_lines('db_query_seconds', 'query')}" \
+           f"• ожидание записи: p95≤{ms(writer_wait.quantile(.95))} мс\n\n" \
+           f"<b>Bot API</b> — ошибок: {errors:g}\n{metric_lines('bot_api_seconds', 'method')}"
+    
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=metrics_keyboard())
+    except TelegramBadRequest:
+        pass  # «message is not modified» при повторном обновлении
+    await callback.answer()
+
 @router.callback_query(F.data == "admin_back")
 async def admin_back(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
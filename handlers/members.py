@@ -0,0 +1,14 @@
+from aiogram import Router
+from aiogram.types import ChatMemberUpdated
+import utils
+
+router = Router()
+
+# Обновления chat_member приходят, только если бот — администратор канала.
+# Они держат кэш подписок свежим без лишних вызовов get_chat_member.
+@router.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    if not utils.is_tracked_chat(event.chat.id):
+        return
+    utils.membership.set(event.new_chat_member.user.id, event.chat.id,
+                         utils.is_member_status(event.new_chat_member.status))
@@ -1,26 +1,33 @@
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery
 import database as db
-from keyboards import main_menu_keyboard
-from config import ADMIN_ID
+from utils import format_rub
+from keyboards import main_menu_keyboard, referrals_keyboard, leaderboard_keyboard
+from config import ADMIN_ID, REF_REWARD, REF_REWARDS
+from notifier import notifier
 
 router = Router()
+# Кто находится на уровне реферального дерева глубже первого
+LEVEL_NAMES = {2: "друзья ваших друзей", 3: "друзья друзей ваших друзей"}
 
-@router.message(F.text == "👤 Мой профиль")
+@router.message(F.text == "👤 Мой профиль", flags={"throttle": "profile"})
 async def profile(message: Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
         await message.answer("Пользователь не найден. Введите /start для регистрации.")
         return
     
-    balance = user[3]
-    referrals = user[4]
-    joined = user[6][:10]
-    
     text = f"👤 <b>Ваш профиль</b>\n\n" \
-           f"💰 Баланс: {balance} руб.\n" \
-           f"👥 Рефералов: {referrals}\n" \
-           f"📅 Зарегистрирован: {joined}"
+           f"💰 Баланс: {format_rub(user.balance)} руб.\n"
+    if user.held:
+        text += f"⏳ На выводе: {format_rub(user.held)} руб.\n"
+    text += f"👥 Рефералов: {user.referrals_count}\n"
+    if user.downline > user.referrals_count:
+        # Глубже первого уровня кто-то есть — показываем команду по уровням
+        levels = await db.get_downline_levels(user.id)
+        text += f"🌳 Вся команда: {user.downline} (" + \
+                ", ".join(f"{level}-й уровень: {count}" for level, count in sorted(levels.items())) + ")\n"
+    text += f"📅 Зарегистрирован: {user.joined_at[:10]}"
     
     await message.answer(text, parse_mode="HTML")
 
@@ -28,26 +35,91 @@ async def profile(message: Message):
 async def referral_link(message: Message):
     bot_username = (await message.bot.me()).username
     link = f"https://t.me/{bot_username}?start={message.from_user.id}"
-    text = f"🔗 Ваша реферальная ссылка:\n\n{link}\n\nПриглашайте друзей и получайте 12 рублей за каждого!"
+    text = f"🔗 Ваша реферальная ссылка:\n\n{link}\n\nПриглашайте друзей и получайте {REF_REWARD} рублей за каждого!"
+    for level, reward in enumerate(REF_REWARDS[1:], 2):
+        if reward:
+            name = LEVEL_NAMES.get(level)
+            text += f"\n{level}-й уровень" + (f" ({name})" if name else "") + f": {reward:g} руб."
     await message.answer(text)
 
-@router.message(F.text == "💸 Вывести средства")
+def referrals_text(user_id: int, referrals) -> str:
+    place, total = db.leaderboard.rank(user_id)
+    text = "👥 <b>Ваши рефералы</b>\n\n"
+    text += f"🏆 Место в рейтинге: {place} из {total}\n\n" if place else "🏆 Пригласите друга, чтобы попасть в рейтинг\n\n"
+    if not referrals:
+        return text + "Пока никого нет — поделитесь реферальной ссылкой."
+    for _, username, rewarded, joined_at in referrals:
+        mark = ("⏳", "✅", "❌", "⏸")[rewarded]
+        text += f"{mark} {'@' + username if username else 'без username'} — {joined_at[:10]}\n"
+    return text + "\n✅ — бонус начислен, ⏳ — ждём подписку на канал, ❌ — бонус отменён, ⏸ — бонус на проверке"
+
+@router.message(F.text == "👥 Мои рефералы", flags={"throttle": "referrals"})
+async def my_referrals(message: Message):
+    referrals, has_next = await db.get_referrals_page(message.from_user.id)
+    await message.answer(referrals_text(message.from_user.id, referrals), parse_mode="HTML",
+                         reply_markup=referrals_keyboard(referrals, False, has_next))
+
+@router.callback_query(F.data == "my_referrals", flags={"throttle": "referrals"})
+async def my_referrals_back(callback: CallbackQuery):
+    referrals, has_next = await db.get_referrals_page(callback.from_user.id)
+    await callback.message.edit_text(referrals_text(callback.from_user.id, referrals), parse_mode="HTML",
+                                     reply_markup=referrals_keyboard(referrals, False, has_next))
+
+@router.callback_query(F.data.startswith("rpage_"), flags={"throttle": "referrals"})
+async def referrals_page(callback: CallbackQuery):
+    _, direction, cursor_id = callback.data.split("_")
+    backward = direction == "prev"
+    referrals, has_more = await db.get_referrals_page(callback.from_user.id, int(cursor_id), backward)
+    if not referrals:
+        await my_referrals_back(callback)
+        return
+    
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    await callback.message.edit_text(referrals_text(callback.from_user.id, referrals), parse_mode="HTML",
+                                     reply_markup=referrals_keyboard(referrals, has_prev, has_next))
+
+@router.callback_query(F.data == "ref_top", flags={"throttle": "referrals"})
+async def referrals_top(callback: CallbackQuery):
+    # Рейтинг целиком в памяти: ни сортировки, ни сканирования users
+    leaders = await db.get_leaderboard(10)
+    text = "🏆 <b>Топ пригласивших</b>\n\n"
+    for place, (user_id, username, count) in enumerate(leaders, 1):
+        you = " ← вы" if user_id == callback.from_user.id else ""
+        text += f"{place}. {'@' + username if username else f'ID {user_id}'} — {count}{you}\n"
+    if not leaders:
+        text += "Пока никто никого не пригласил."
+    place, total = db.leaderboard.rank(callback.from_user.id)
+    if place and place > len(leaders):
+        text += f"\nВаше место: {place} из {total}"
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=leaderboard_keyboard())
+
+@router.message(F.text == "💸 Вывести средства", flags={"priority": "money"})
 async def withdrawal(message: Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
         await message.answer("Сначала зарегистрируйтесь через /start")
         return
     
-    balance = user[3]
-    if balance < 600:
-        await message.answer(f"❌ Минимальная сумма для вывода – 600 руб. Ваш баланс: {balance} руб.")
+    # Выводятся целые рубли, копейки остаются на балансе
+    amount = user.balance // db.KOPECKS
+    if amount < 600:
+        await message.answer(f"❌ Минимальная сумма для вывода – 600 руб. Ваш баланс: {format_rub(user.balance)} руб.")
         return
     
-    db.add_withdrawal(message.from_user.id, balance)
+    if await db.add_withdrawal(message.from_user.id, amount) is None:
+        await message.answer("❌ Недостаточно средств: баланс изменился. Попробуйте ещё раз.")
+        return
+    # add_withdrawal положил в кэш свежую строку — hold актуален на момент заявки
+    user = await db.get_user(message.from_user.id)
+    if user.hold:
+        await message.answer("⏳ Заявка на вывод создана и будет рассмотрена после проверки аккаунта.")
+        notifier.send(ADMIN_ID, f"⏸ Заявка на вывод {amount} руб. от {message.from_user.id} задержана "
+                                f"антифродом: {user.hold} — /holds")
+        return
     await message.answer("✅ Заявка на вывод создана. Ожидайте подтверждения администратора.")
     
     # Уведомление админу
-    await message.bot.send_message(
+    notifier.send(
         ADMIN_ID,
-        f"💰 Новая заявка на вывод от @{message.from_user.username or 'no_username'} (ID: {message.from_user.id})\nСумма: {balance} руб."
+        f"💰 Новая заявка на вывод от @{message.from_user.username or 'no_username'} (ID: {message.from_user.id})\nСумма: {amount} руб."
     )
\ No newline at end of file
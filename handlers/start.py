@@ -1,82 +1,102 @@
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import CommandStart
-from aiogram.utils.deep_link import decode_payload
+from aiogram.utils.deep_linking import decode_payload
 import database as db
+import fraud
 import utils
+from notifier import notifier
 from keyboards import main_menu_keyboard, subscription_keyboard
-from config import ADMIN_ID
+from config import ADMIN_ID, REF_REWARDS
 
 router = Router()
 
-@router.message(CommandStart(deep_link=True))
-async def start_deep_link(message Message, bot)
-    payload = decode_payload(message.text.split()[1])
-    try
-        referrer_id = int(payload)
-    except ValueError
-        referrer_id = None
+def parse_referrer(arg: str):
+    # Ссылка из меню содержит id как есть, закодированные ссылки тоже поддерживаем
+    try:
+        return int(arg)
+    except ValueError:
+        pass
+    try:
+        return int(decode_payload(arg))
+    except ValueError:
+        return None
+
+async def credit_referrer(referrer_id: int, user_id: int):
+    rewards = [round(reward * db.KOPECKS) for reward in REF_REWARDS]
+    for ancestor_id, amount, level in await db.credit_referral(user_id, referrer_id, rewards):
+        notifier.notify_referral(ancestor_id, amount, direct=level == 1)
+
+async def reward_referrer(bot, referrer_id: int, user_id: int):
+    # Повторный /start уже засчитанного приглашённого не доходит до базы
+    user = await db.get_user(user_id)
+    if user is None or user.rewarded:
+        return
+    fraud.detector.observe_pass(referrer_id)
+    referrer = await db.get_user(referrer_id)
+    if referrer is not None and referrer.hold:
+        # Реферер на проверке антифрода: бонус ждёт решения админа (/holds)
+        await db.hold_referral(user_id, referrer_id)
+        return
+    await credit_referrer(referrer_id, user_id)
+
+@router.message(CommandStart(deep_link=True), flags={"throttle": "start"})
+async def start_deep_link(message: Message, bot):
+    referrer_id = parse_referrer(message.text.split()[1])
     await start_handler(message, bot, referrer_id)
 
-@router.message(CommandStart())
-async def start_no_link(message Message, bot)
+@router.message(CommandStart(), flags={"throttle": "start"})
+async def start_no_link(message: Message, bot):
     await start_handler(message, bot, None)
 
-async def start_handler(message Message, bot, referrer_id int = None)
+async def start_handler(message: Message, bot, referrer_id: int = None):
     user_id = message.from_user.id
-    username = message.from_user.username or no_username
-    is_new = db.add_user(user_id, username, referrer_id)
-    settings = db.get_settings()
-    
+    username = message.from_user.username
+    is_new = await db.add_user(user_id, username, referrer_id)
+    if is_new and referrer_id and referrer_id != user_id:
+        reason = fraud.detector.observe_signup(referrer_id, message.from_user)
+        if reason:
+            await fraud.flag(referrer_id, reason)
+    settings = await db.get_settings()
+
     # Проверка подписки
-    if settings[enabled] and settings[channel]
-        subscribed = await utils.check_subscription(user_id, bot, settings[channel])
-        if not subscribed
+    if settings["enabled"] and settings["channels"]:
+        missing = await utils.missing_channels(user_id, bot, settings["channels"])
+        if missing:
+            await db.record_event("gate_shown")
             await message.answer(
-                Для использования бота необходимо подписаться на канал.n
-                После подписки нажмите кнопку 'Проверить подписку'.,
-                reply_markup=subscription_keyboard(settings[channel])
+                "Для использования бота необходимо подписаться на каналы.\n"
+                "После подписки нажмите кнопку 'Проверить подписку'.",
+                reply_markup=subscription_keyboard(missing)
             )
             return
-    
+
     # Начисление бонуса рефереру
-    if referrer_id and referrer_id != user_id
-        user = db.get_user(user_id)
-        if user and user[5] == 0
-            db.update_user_balance(referrer_id, 12)
-            db.increment_referrals(referrer_id)
-            db.mark_rewarded(user_id)
-            try
-                await bot.send_message(referrer_id, 🎉 По вашей ссылке зарегистрировался новый пользователь! Вам начислено 12 рублей.)
-            except
-                pass
-    
+    if referrer_id and referrer_id != user_id:
+        await reward_referrer(bot, referrer_id, user_id)
+
     await message.answer(
-        fДобро пожаловать, {message.from_user.full_name}!n
-        Используйте меню для навигации.,
+        f"Добро пожаловать, {message.from_user.full_name}!\n"
+        "Используйте меню для навигации.",
         reply_markup=main_menu_keyboard()
     )
 
-@router.callback_query(F.data == check_sub)
-async def check_sub_callback(callback CallbackQuery, bot)
+@router.callback_query(F.data == "check_sub", flags={"throttle": "check_sub"})
+async def check_sub_callback(callback: CallbackQuery, bot):
     user_id = callback.from_user.id
-    settings = db.get_settings()
-    
-    if settings[enabled] and settings[channel]
-        subscribed = await utils.check_subscription(user_id, bot, settings[channel])
-        if subscribed
-            user = db.get_user(user_id)
-            if user and user[2] and user[5] == 0
-                db.update_user_balance(user[2], 12)
-                db.increment_referrals(user[2])
-                db.mark_rewarded(user_id)
-                try
-                    await bot.send_message(user[2], 🎉 По вашей ссылке зарегистрировался новый пользователь! Вам начислено 12 рублей.)
-                except
-                    pass
+    settings = await db.get_settings()
+
+    if settings["enabled"] and settings["channels"]:
+        missing = await utils.missing_channels(user_id, bot, settings["channels"], fresh=True)
+        if not missing:
+            await db.record_event("gate_passed")
+            user = await db.get_user(user_id)
+            if user and user.referrer_id and not user.rewarded:
+                await reward_referrer(bot, user.referrer_id, user_id)
             await callback.message.delete()
-            await callback.message.answer(✅ Спасибо за подписку! Добро пожаловать., reply_markup=main_menu_keyboard())
-        else
-            await callback.answer(❌ Вы ещё не подписались на канал. Попробуйте снова после подписки., show_alert=True)
-    else
-        await callback.answer(Проверка подписки не требуется., show_alert=True)
\ No newline at end of file
+            await callback.message.answer("✅ Спасибо за подписку! Добро пожаловать.", reply_markup=main_menu_keyboard())
+        else:
+            channels = ", ".join(f"@{channel}" for channel in missing)
+            await callback.answer(f"❌ Вы ещё не подписались: {channels}. Попробуйте снова после подписки.", show_alert=True)
+    else:
+        await callback.answer("Проверка подписки не требуется.", show_alert=True)
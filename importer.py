@@ -0,0 +1,168 @@
+"""Перенос пользователей из старой базы в bot.db без остановки бота.
+
+    python -m importer refer_bot.db
+
+Понимает схему старого бота из main.py (refer_bot.db: users.user_id, балансы REAL в рублях,
+каналы в таблице channels) и схему bot.db — например, чтобы слить базу второго экземпляра.
+Источник читается пачками по первичному ключу, каждая пачка пишется короткой транзакцией
+через групповой коммит, так что живые обновления проходят между пачками. Прогресс хранится
+в таблице imports: прерванный импорт продолжается с места остановки без повторных начислений.
+Из админки то же самое запускает команда /import <путь>.
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+import aiosqlite
+
+import database as db
+
+IMPORT_CHUNK = 5000
+# Пауза между пачками — место для записей живого трафика
+IMPORT_PAUSE = 0.05
+
+# Строки источника: (id, username, referrer_id, rewarded, рефералов, баланс в копейках, joined_at)
+LEGACY_USERS = f"""
+    SELECT user_id, NULLIF(username, '—'), NULLIF(NULLIF(ref_by, 0), user_id), ref_rewarded, refs_count,
+           CAST(ROUND(balance * {db.KOPECKS}) AS INTEGER), joined_at
+    FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+"""
+BOT_USERS = f"""
+    SELECT id, NULLIF(username, 'no_username'), NULLIF(referrer_id, id), rewarded, referrals_count, balance * {db.KOPECKS}, joined_at
+    FROM users WHERE id > ? ORDER BY id LIMIT ?
+"""
+# bot.db после перехода на ledger: замороженное под заявки возвращается на баланс — заявки не переносятся
+BOT_LEDGER_USERS = """
+    SELECT u.id, NULLIF(u.username, 'no_username'), NULLIF(u.referrer_id, u.id), u.rewarded,
+           COALESCE(b.referrals, 0) + (SELECT COALESCE(SUM((kind = 'referral') - (kind = 'clawback')), 0) FROM ledger
+                                       WHERE user_id = u.id AND id > COALESCE(b.ledger_id, 0)),
+           (SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE user_id = u.id),
+           u.joined_at
+    FROM users u LEFT JOIN balances b ON b.user_id = u.id
+    WHERE u.id > ? ORDER BY u.id LIMIT ?
+"""
+
+_task = None
+
+
+async def _columns(conn, table):
+    async with conn.execute(f"PRAGMA table_info({table})") as cur:
+        return {row[1] for row in await cur.fetchall()}
+
+
+async def _source_query(conn):
+    """(запрос пачки пользователей, старая ли это схема main.py)."""
+    if "user_id" in await _columns(conn, "users"):
+        return LEGACY_USERS, True
+    if await _columns(conn, "ledger"):
+        return BOT_LEDGER_USERS, False
+    return BOT_USERS, False
+
+
+async def _source_channels(conn, legacy: bool):
+    """(каналы без @, включена ли проверка подписки) из настроек источника."""
+    if legacy:
+        async with conn.execute("SELECT username FROM channels WHERE username IS NOT NULL") as cur:
+            channels = [row[0].lstrip("@") for row in await cur.fetchall()]
+        async with conn.execute("SELECT value FROM settings WHERE key = 'require_subscription'") as cur:
+            row = await cur.fetchone()
+        return channels, row is not None and row[0] == "true"
+    async with conn.execute("SELECT required_channel, check_subscription FROM settings WHERE id = 1") as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return [], False
+    return (row[0] or "").split(), bool(row[1])
+
+
+async def _ranges(chunk: int):
+    """Диапазоны id пользователей bot.db по chunk штук — для пересборки дерева по частям."""
+    after = 0
+    while True:
+        last = await db.next_users_bound(after, chunk)
+        if last is None:
+            return
+        yield after + 1, last
+        after = last
+
+
+async def run_import(path: str, chunk: int = IMPORT_CHUNK):
+    """Импортирует path в текущую базу; возвращает (новых пользователей, слитых с существующими)."""
+    source = os.path.abspath(path)
+    last_id, imported, merged, finished = await db.start_import(source)
+    if finished:
+        logging.info("Import of %s already finished at %s", source, finished)
+        return imported, merged
+    if last_id:
+        logging.info("Resuming import of %s after user %d", source, last_id)
+    # Источник только читается: mode=ro не даст случайно его изменить
+    async with aiosqlite.connect(f"file:{source}?mode=ro", uri=True) as conn:
+        query, legacy = await _source_query(conn)
+        while True:
+            async with conn.execute(query, (last_id, chunk)) as cur:
+                rows = await cur.fetchall()
+            if not rows:
+                break
+            result = await db.import_users(source, rows)
+            if result is not None:
+                imported += result[0]
+                merged += result[1]
+            last_id = rows[-1][0]
+            logging.info("Imported %d users, merged %d (last id %d)", imported, merged, last_id)
+            await asyncio.sleep(IMPORT_PAUSE)
+        channels, enabled = await _source_channels(conn, legacy)
+    # Каналы переносим, только если в новой базе их ещё не настроили
+    settings = await db.get_settings()
+    if channels and not settings["channels"]:
+        await db.update_settings(" ".join(channels), enabled)
+    # Реферер мог прийти в более поздней пачке, чем приглашённый, — дерево достраиваем после всех пачек,
+    # уровень за уровнем и тоже короткими транзакциями
+    for depth in range(1, db.REFERRAL_DEPTH + 1):
+        async for first, last in _ranges(chunk):
+            await db.link_referrals(first, last, depth)
+            await asyncio.sleep(IMPORT_PAUSE)
+    async for first, last in _ranges(chunk):
+        await db.recount_downline(first, last)
+        await asyncio.sleep(IMPORT_PAUSE)
+    await db.finish_import(source)
+    logging.info("Import of %s finished: %d new users, %d merged", source, imported, merged)
+    return imported, merged
+
+
+def running() -> bool:
+    return _task is not None and not _task.done()
+
+
+def start(path: str, on_done):
+    """Запускает импорт фоном в работающем боте; on_done(текст) получает итог."""
+    global _task
+
+    async def job():
+        try:
+            imported, merged = await run_import(path)
+        except Exception as e:
+            logging.exception("Import of %s failed", path)
+            on_done(f"❌ Импорт {path} прерван: {e}\nПовторный /import продолжит с места остановки.")
+        else:
+            on_done(f"✅ Импорт {path} завершён: новых пользователей {imported}, слито с существующими {merged}.")
+
+    _task = asyncio.create_task(job())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Merge a legacy bot database into bot.db")
+    parser.add_argument("path", help="старая база: refer_bot.db или bot.db другого экземпляра")
+    parser.add_argument("--chunk", type=int, default=IMPORT_CHUNK, help="пользователей в одной транзакции")
+    args = parser.parse_args()
+    # Запущенный бот узнаёт об импортированных пользователях из ленты изменений
+    db.share_user_changes = True
+    await db.init_db()
+    try:
+        await run_import(args.path, args.chunk)
+    finally:
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -4,23 +4,24 @@ def main_menu_keyboard():
     kb = [
         [KeyboardButton(text="👤 Мой профиль")],
         [KeyboardButton(text="🔗 Реферальная ссылка")],
+        [KeyboardButton(text="👥 Мои рефералы")],
         [KeyboardButton(text="💸 Вывести средства")]
     ]
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
-def subscription_keyboard(channel: str):
-    url = f"https://t.me/{channel}" if channel else ""
-    kb = [
-        [InlineKeyboardButton(text="📢 Подписаться", url=url)],
-        [InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]
-    ]
+def subscription_keyboard(channels):
+    kb = [[InlineKeyboardButton(text=f"📢 Подписаться на @{channel}", url=f"https://t.me/{channel}")]
+          for channel in channels]
+    kb.append([InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 def admin_menu_keyboard():
     kb = [
         [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="💰 Заявки на вывод", callback_data="admin_withdrawals")]
+        [InlineKeyboardButton(text="💰 Заявки на вывод", callback_data="admin_withdrawals")],
+        [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
@@ -29,19 +30,41 @@ def settings_keyboard(enabled: bool, channel: str):
     kb = [
         [InlineKeyboardButton(text=f"Проверка подписки: {status}", callback_data="toggle_sub_check")],
         [InlineKeyboardButton(text="Изменить канал", callback_data="set_channel")],
+        [InlineKeyboardButton(text="⏱ Лимиты антифлуда", callback_data="set_throttle")],
         [InlineKeyboardButton(text="« Назад", callback_data="admin_back")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def withdrawals_keyboard(withdrawals):
+def withdrawals_keyboard(withdrawals, has_prev: bool = False, has_next: bool = False):
     kb = []
     for w in withdrawals:
         w_id, user_id, amount, created = w
         kb.append([InlineKeyboardButton(text=f"Заявка #{w_id}: {amount} руб. от {user_id}",
                                         callback_data=f"withdraw_{w_id}")])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"wpage_prev_{withdrawals[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"wpage_next_{withdrawals[-1][0]}"))
+    if nav:
+        kb.append(nav)
+    if withdrawals:
+        page = f"page_{withdrawals[0][0]}_{withdrawals[-1][0]}"
+        kb.append([InlineKeyboardButton(text="✅ Одобрить страницу", callback_data=f"wbulk_approved_{page}"),
+                   InlineKeyboardButton(text="❌ Отклонить страницу", callback_data=f"wbulk_rejected_{page}")])
+    kb.append([InlineKeyboardButton(text="🧮 Массовая обработка по фильтру", callback_data="wbulk_filter")])
     kb.append([InlineKeyboardButton(text="« Назад", callback_data="admin_back")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+def bulk_confirm_keyboard(max_amount: int, days: int):
+    flt = f"filter_{max_amount}_{days}"
+    kb = [
+        [InlineKeyboardButton(text="✅ Одобрить все", callback_data=f"wbulk_approved_{flt}")],
+        [InlineKeyboardButton(text="❌ Отклонить все", callback_data=f"wbulk_rejected_{flt}")],
+        [InlineKeyboardButton(text="« Назад", callback_data="admin_withdrawals")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
 def withdrawal_action_keyboard(w_id: int):
     kb = [
         [InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve_{w_id}")],
@@ -49,3 +72,45 @@ def withdrawal_action_keyboard(w_id: int):
         [InlineKeyboardButton(text="« Назад", callback_data="admin_withdrawals")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def broadcast_keyboard(running: bool):
+    kb = []
+    if running:
+        kb.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_broadcast")])
+        kb.append([InlineKeyboardButton(text="⏹ Остановить", callback_data="broadcast_cancel")])
+    kb.append([InlineKeyboardButton(text="« Назад", callback_data="admin_back")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def metrics_keyboard():
+    kb = [
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_metrics")],
+        [InlineKeyboardButton(text="« Назад", callback_data="admin_back")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def referrals_keyboard(referrals, has_prev: bool = False, has_next: bool = False):
+    kb = []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"rpage_prev_{referrals[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"rpage_next_{referrals[-1][0]}"))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton(text="🏆 Топ пригласивших", callback_data="ref_top")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def leaderboard_keyboard():
+    kb = [[InlineKeyboardButton(text="« Мои рефералы", callback_data="my_referrals")]]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def holds_keyboard(holds):
+    kb = [[InlineKeyboardButton(text=f"✅ Снять {user_id}", callback_data=f"hold_release_{user_id}"),
+           InlineKeyboardButton(text=f"❌ Отклонить {user_id}", callback_data=f"hold_reject_{user_id}")]
+          for user_id, *_ in holds]
+    kb.append([InlineKeyboardButton(text="« Назад", callback_data="admin_back")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def retry_start_keyboard(url: str):
+    kb = [[InlineKeyboardButton(text="🔄 Попробовать снова", url=url)]]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
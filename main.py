@@ -13,6 +13,13 @@ from aiogram.enums import ParseMode
 
 import aiosqlite
 
+import database
+import utils
+from config import BOT_MODE
+from fsm_storage import SQLiteStorage
+from webhook import run_webhook
+from notifier import notifier
+
 logging.basicConfig(level=logging.INFO)
 
 # ================== НАСТРОЙКИ ==================
@@ -22,7 +29,7 @@ DB_NAME = "refer_bot.db"
 # ===============================================
 
 bot = Bot(token=TOKEN, parse_mode="HTML")
-dp = Dispatcher()
+dp = Dispatcher(storage=SQLiteStorage())
 
 # ================== FSM ==================
 class WithdrawStates(StatesGroup):
@@ -63,47 +70,47 @@ async def init_db():
         """)
         await db.commit()
 
-async def get_setting(key: str) -> str:
+# Настройки читаются из памяти; база трогается только при старте и при записи
+_settings_cache: dict = {}
+
+async def load_settings():
+    global _settings_cache
     async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT value FROM settings WHERE key=?", (key,)) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else None
+        async with db.execute("SELECT key, value FROM settings") as cur:
+            _settings_cache = dict(await cur.fetchall())
+
+async def get_setting(key: str) -> str:
+    return _settings_cache.get(key)
 
 async def set_setting(key: str, value: str):
+    global _settings_cache
     async with aiosqlite.connect(DB_NAME) as db:
         await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
         await db.commit()
+    _settings_cache = {**_settings_cache, key: value}
 
 # ================== ФУНКЦИИ ==================
-async def check_subscription(user_id: int) -> bool:
+async def check_subscription(user_id: int, fresh: bool = False) -> bool:
     async with aiosqlite.connect(DB_NAME) as db:
         async with db.execute("SELECT channel_id FROM channels") as cur:
-            channels = await cur.fetchall()
-    if not channels:
-        return True
-    for (ch_id,) in channels:
-        try:
-            member = await bot.get_chat_member(ch_id, user_id)
-            if member.status not in ["member", "administrator", "creator"]:
-                return False
-        except:
-            return False
-    return True
+            channels = [ch_id for (ch_id,) in await cur.fetchall()]
+    # Каналы проверяются параллельно в общем бюджете запросов к API
+    return not await utils.missing_channels(user_id, bot, channels, fresh)
 
 async def reward_referrer(ref_id: int, new_user_id: int):
+    reward = float(await get_setting('ref_reward'))
     async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT ref_rewarded FROM users WHERE user_id=?", (new_user_id,)) as cur:
-            row = await cur.fetchone()
-            if row and row[0] == 1:
+        # Флаг ref_rewarded и баланс реферера меняются в одной транзакции
+        async with db.execute(
+            "UPDATE users SET ref_rewarded=1 WHERE user_id=? AND ref_rewarded=0", (new_user_id,)
+        ) as cur:
+            if cur.rowcount != 1:
                 return
-        reward = float(await get_setting('ref_reward'))
-        await db.execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (reward, ref_id))
-        await db.execute("UPDATE users SET ref_rewarded=1, refs_count=refs_count+1 WHERE user_id=?", (new_user_id,))
+        await db.execute("UPDATE users SET balance = balance + ?, refs_count = refs_count + 1 WHERE user_id=?",
+                         (reward, ref_id))
         await db.commit()
-        try:
-            await bot.send_message(ref_id, f"🎉 <b>Новый реферал!</b>\n\n+{reward} ₽ на баланс!", parse_mode="HTML")
-        except:
-            pass
+    # Уведомления считают в копейках, как и основной бот
+    notifier.notify_referral(ref_id, round(reward * database.KOPECKS))
 
 async def main_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -161,7 +168,7 @@ async def start(message: types.Message):
 
 @dp.callback_query(F.data == "check_sub")
 async def check_sub(callback: types.CallbackQuery):
-    if await check_subscription(callback.from_user.id):
+    if await check_subscription(callback.from_user.id, fresh=True):
         async with aiosqlite.connect(DB_NAME) as db:
             async with db.execute("SELECT ref_by FROM users WHERE user_id=?", (callback.from_user.id,)) as cur:
                 ref_by = (await cur.fetchone())[0]
@@ -191,7 +198,18 @@ async def admin(message: types.Message):
 # ================== ЗАПУСК ==================
 async def main():
     await init_db()
-    await dp.start_polling(bot)
+    await load_settings()
+    # Очередь уведомлений хранит недоставленные сообщения в базе bot.db
+    await database.init_db()
+    await notifier.start(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await notifier.stop()
+        await database.close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
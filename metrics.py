@@ -0,0 +1,235 @@
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 512)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись — один bisect и два сложения."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """Метрики процесса в памяти; отдаются в формате Prometheus и в админку."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._collectors = {}
+
+    def histogram(self, name: str, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, delta: float, **labels):
+        key = _key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def collect(self, name: str, fn, kind: str = "gauge"):
+        """Значение, которое считается только в момент чтения метрик (длина очереди и т.п.)."""
+        self._collectors[name] = (fn, kind)
+
+    def value(self, name: str, **labels) -> float:
+        key = _key(name, labels)
+        if name in self._collectors:
+            return self._collectors[name][0]()
+        return self.counters.get(key, self.gauges.get(key, 0))
+
+    def summary(self, name: str, label: str):
+        """[(значение метки, count, p50, p95, sum)] по убыванию суммарного времени."""
+        rows = [(dict(labels).get(label, ""), h.count, h.quantile(.5), h.quantile(.95), h.sum)
+                for (metric, labels), h in self.histograms.items() if metric == name and h.count]
+        return sorted(rows, key=lambda row: row[4], reverse=True)
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for values, kind in ((self.counters, "counter"), (self.gauges, "gauge")):
+            for (name, labels), value in sorted(values.items()):
+                declare(name, kind)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, (fn, kind) in sorted(self._collectors.items()):
+            try:
+                value = fn()
+            except Exception:
+                logging.exception("Metric collector %s failed", name)
+                continue
+            declare(name, kind)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed(name: str, **labels):
+    """Декоратор корутины: время выполнения в гистограмму name{query=<имя функции>}."""
+    def decorator(func):
+        histogram = registry.histogram(name, query=func.__name__, **labels)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def callback_prefix(data: str) -> str:
+    # approve_15 -> approve, wbulk_approved_page_3_9 -> wbulk_approved_page: id не плодят метки
+    parts = []
+    for part in data.split("_"):
+        if part.lstrip("-").isdigit():
+            break
+        parts.append(part)
+    return "_".join(parts) or "-"
+
+
+class UpdateMetrics(BaseMiddleware):
+    """Внешний middleware: обновления в обработке и полное время обработки по типу."""
+
+    async def __call__(self, handler, event, data):
+        update_type = event.event_type
+        registry.add("bot_updates_in_flight", 1)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            registry.inc("bot_update_errors_total", type=update_type)
+            raise
+        finally:
+            registry.add("bot_updates_in_flight", -1)
+            registry.observe("bot_update_seconds", time.perf_counter() - started, type=update_type)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Внутренний middleware: время хендлера по имени, префиксу callback_data и состоянию FSM."""
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            callback = data["handler"].callback
+            registry.observe("bot_handler_seconds", elapsed, handler=getattr(callback, "__name__", "-"))
+            if isinstance(event, CallbackQuery) and event.data:
+                registry.observe("bot_callback_seconds", elapsed, prefix=callback_prefix(event.data))
+            state = data.get("raw_state")
+            if state:
+                registry.observe("bot_state_seconds", elapsed, state=state)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки каждого метода Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            registry.inc("bot_api_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            registry.observe("bot_api_seconds", time.perf_counter() - started, method=name)
+
+
+def instrument(dp):
+    dp.update.outer_middleware(UpdateMetrics())
+    handler_metrics = HandlerMetrics()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(handler_metrics)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(ApiMetrics())
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host: str, port: int):
+    """Локальный HTTP /metrics для Prometheus; возвращает runner (None, если порт 0)."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Metrics available at http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+import metrics
+import utils
+
+# Лимиты Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+SEND_CONCURRENCY = 30
+CHAT_INTERVAL = 1.0
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+# Первое уведомление о реферале уходит сразу, следующие за это окно склеиваются в одно сообщение
+COALESCE_WINDOW = 60
+# Сколько при остановке ждать отправок, которые уже начались
+STOP_TIMEOUT = 10
+
+
+class Outgoing:
+    __slots__ = ("chat_id", "text", "kwargs", "attempts")
+
+    def __init__(self, chat_id: int, text: str, kwargs=None, attempts: int = 0):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs or {}
+        self.attempts = attempts
+
+
+class Notifier:
+    """Фоновая доставка сообщений с общим лимитом, паузой между сообщениями в чат и повторами."""
+
+    def __init__(self, rate: float = GLOBAL_RATE, chat_interval: float = CHAT_INTERVAL):
+        self.limiter = utils.RateLimiter(rate, SEND_CONCURRENCY)
+        self.chat_interval = chat_interval
+        self.bot = None
+        self._chats = {}       # chat_id -> очередь сообщений этого чата
+        self._heap = []        # (когда можно слать, seq, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._referrals = {}   # chat_id -> [количество, сумма] в текущем окне
+        self._task = None
+        self._deliveries = set()
+        self._sending = set()  # чаты, чьё первое сообщение сейчас отправляется
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        # Сообщения, не доставленные в прошлый раз
+        for chat_id, text in await db.take_outbox():
+            self.send(chat_id, text)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._deliveries:
+            # Начатые отправки доводим до конца, зависшие отменяем; их сообщения в outbox не идут —
+            # они могли уже дойти, и после перезапуска пришли бы дважды
+            _, pending = await asyncio.wait(self._deliveries, timeout=STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for chat_id in list(self._referrals):
+            self._flush_referrals(chat_id)
+        undelivered = [(m.chat_id, m.text) for chat_id, queue in self._chats.items()
+                       for m in list(queue)[chat_id in self._sending:]]
+        self._sending.clear()
+        self._chats.clear()
+        self._heap.clear()
+        if undelivered:
+            await db.save_outbox(undelivered)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._chats.values())
+
+    def send(self, chat_id: int, text: str, **kwargs):
+        """Ставит сообщение в очередь и сразу возвращает управление."""
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            self._schedule(chat_id, time.monotonic())
+        queue.append(Outgoing(chat_id, text, kwargs))
+
+    def notify_referral(self, chat_id: int, amount: int, direct: bool = True):
+        """Уведомление о начислении amount копеек (direct=False — за реферала 2-го уровня и глубже).
+        Первое уходит сразу, начисления за следующие COALESCE_WINDOW секунд склеиваются в одно."""
+        pending = self._referrals.get(chat_id)
+        if pending is not None:
+            pending[0] += direct
+            pending[1] += amount
+            return
+        self.send(chat_id, self._referral_text(int(direct), amount))
+        self._open_window(chat_id)
+
+    def _open_window(self, chat_id: int):
+        self._referrals[chat_id] = [0, 0]
+        asyncio.get_running_loop().call_later(COALESCE_WINDOW, self._flush_referrals, chat_id)
+
+    def _flush_referrals(self, chat_id: int):
+        pending = self._referrals.pop(chat_id, None)
+        if pending is None or pending == [0, 0]:
+            return
+        self.send(chat_id, self._referral_text(*pending))
+        if self._task is not None:
+            # Поток не иссяк — следующее окно тоже склеиваем
+            self._open_window(chat_id)
+
+    @staticmethod
+    def _referral_text(count: int, amount: int) -> str:
+        if count == 0:
+            return f"🎉 +{utils.format_rub(amount)} ₽ — бонус за пользователей, которых пригласили ваши рефералы!"
+        if count == 1:
+            return f"🎉 По вашей ссылке зарегистрировался новый пользователь! Вам начислено {utils.format_rub(amount)} руб."
+        return f"🎉 +{utils.format_rub(amount)} ₽: по вашей ссылке зарегистрировались {count} новых пользователей!"
+
+    def _schedule(self, chat_id: int, at: float):
+        heapq.heappush(self._heap, (at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                # Ждём своей очереди, но просыпаемся, если появился чат пораньше
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id = heapq.heappop(self._heap)
+            await self.limiter.acquire()
+            task = asyncio.create_task(self._deliver(chat_id))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int):
+        queue = self._chats[chat_id]
+        message = queue[0]
+        next_at = time.monotonic() + self.chat_interval
+        self._sending.add(chat_id)
+        try:
+            await self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+            queue.popleft()
+        except TelegramRetryAfter as e:
+            self.limiter.pause(e.retry_after)
+            next_at = time.monotonic() + e.retry_after
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или чата нет — повторять бессмысленно
+            logging.info("Dropping message to %s: %s", chat_id, e)
+            queue.popleft()
+        except Exception:
+            message.attempts += 1
+            if message.attempts >= MAX_ATTEMPTS:
+                logging.exception("Giving up on message to %s, saving to outbox", chat_id)
+                queue.popleft()
+                await db.save_outbox([(message.chat_id, message.text)])
+            else:
+                next_at = time.monotonic() + RETRY_DELAY * message.attempts
+        finally:
+            self.limiter.release()
+        # При отмене (stop) чат остаётся в _sending: его сообщение в outbox не попадёт
+        self._sending.discard(chat_id)
+        if queue:
+            self._schedule(chat_id, next_at)
+        else:
+            self._chats.pop(chat_id, None)
+
+
+notifier = Notifier()
+metrics.registry.collect("notifier_queued", lambda: notifier.queued)
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from collections import deque
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+
+import database as db
+import metrics
+from config import ADMIN_ID, SCHEDULER_CONCURRENCY, SHED_SLO
+from keyboards import retry_start_keyboard
+
+# Классы по убыванию приоритета: освободившийся слот достаётся первому ждущему сверху
+ADMIN, MONEY, MENU, ONBOARDING = "admin", "money", "menu", "onboarding"
+CLASSES = (ADMIN, MONEY, MENU, ONBOARDING)
+# Доля общего бюджета, которую может занять класс: регистрации никогда не забирают всё,
+# админ — один человек, его ограничивает только общий бюджет
+CLASS_SHARES = {ADMIN: 1.0, MONEY: 0.25, MENU: 0.5, ONBOARDING: 0.75}
+# Ждущие этих классов сбрасываются по SLO, остальные ждут сколько нужно
+SHEDDABLE = (ONBOARDING,)
+MAX_QUEUE = 1000
+# Ответов «попробуйте позже» в секунду: в волну они сами упирались бы в лимиты Telegram
+SHED_REPLY_RATE = 5
+SHED_TEXT = "⏳ Сейчас очень много новых пользователей. Попробуйте ещё раз через минуту."
+
+
+def from_admin(update: dict) -> bool:
+    """Сырое обновление от админа: такие идут в обход общих очередей webhook и супервизора."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"] == ADMIN_ID
+    return False
+
+
+class Scheduler:
+    """Общий бюджет одновременных хендлеров процесса, поделённый между классами приоритета."""
+
+    def __init__(self, total: int = SCHEDULER_CONCURRENCY, slo: float = SHED_SLO, max_queue: int = MAX_QUEUE):
+        self.slo = slo
+        self.max_queue = max_queue
+        self.running = dict.fromkeys(CLASSES, 0)
+        self.queued = dict.fromkeys(CLASSES, 0)
+        self._waiting = {priority: deque() for priority in CLASSES}
+        self.resize(total)
+
+    def resize(self, total: int):
+        self.total = total
+        self.limits = {priority: max(1, int(total * share)) for priority, share in CLASS_SHARES.items()}
+        self._wake()
+
+    def _free(self, priority: str) -> bool:
+        return sum(self.running.values()) < self.total and self.running[priority] < self.limits[priority]
+
+    def _take(self, priority: str):
+        self.running[priority] += 1
+        metrics.registry.add("scheduler_running", 1, priority=priority)
+
+    def _wake(self):
+        for priority in CLASSES:
+            waiting = self._waiting[priority]
+            while waiting and self._free(priority):
+                waiter = waiting.popleft()
+                # Сброшенные по SLO и отменённые остаются в очереди до первого прохода
+                if not waiter.done():
+                    self._take(priority)
+                    waiter.set_result(True)
+
+    async def acquire(self, priority: str) -> bool:
+        """Ждёт слот класса; False — ожидание сброшено (SLO или переполнение очереди)."""
+        waiting = self._waiting[priority]
+        while waiting and waiting[0].done():
+            waiting.popleft()
+        if not waiting and self._free(priority):
+            self._take(priority)
+            metrics.registry.observe("scheduler_wait_seconds", 0, priority=priority)
+            return True
+        sheddable = priority in SHEDDABLE
+        if sheddable and self.queued[priority] >= self.max_queue:
+            metrics.registry.inc("scheduler_shed_total", priority=priority, reason="queue")
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        waiting.append(waiter)
+        timer = asyncio.get_running_loop().call_later(self.slo, self._expire, waiter) if sheddable else None
+        self.queued[priority] += 1
+        metrics.registry.add("scheduler_queued", 1, priority=priority)
+        started = time.perf_counter()
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            # Слот успели выдать, а задачу отменили до того, как она его заняла
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.release(priority)
+            raise
+        finally:
+            self.queued[priority] -= 1
+            metrics.registry.add("scheduler_queued", -1, priority=priority)
+            if timer is not None:
+                timer.cancel()
+        if granted:
+            metrics.registry.observe("scheduler_wait_seconds", time.perf_counter() - started, priority=priority)
+        else:
+            metrics.registry.inc("scheduler_shed_total", priority=priority, reason="slo")
+        return granted
+
+    @staticmethod
+    def _expire(waiter):
+        if not waiter.done():
+            waiter.set_result(False)
+
+    def release(self, priority: str):
+        self.running[priority] -= 1
+        metrics.registry.add("scheduler_running", -1, priority=priority)
+        self._wake()
+
+
+scheduler = Scheduler()
+_shed_replies = [SHED_REPLY_RATE, time.monotonic()]  # токены, время пополнения
+
+
+def _reply_allowed() -> bool:
+    now = time.monotonic()
+    tokens = min(SHED_REPLY_RATE, _shed_replies[0] + (now - _shed_replies[1]) * SHED_REPLY_RATE)
+    allowed = tokens >= 1
+    _shed_replies[:] = [tokens - allowed, now]
+    return allowed
+
+
+async def shed(event):
+    """Быстрый ответ вместо обработки: без запросов к БД и проверки подписки.
+    Сверх SHED_REPLY_RATE сообщения молча отбрасываются, нажатие кнопки всё равно гасится."""
+    allowed = _reply_allowed()
+    if isinstance(event, CallbackQuery):
+        await event.answer(SHED_TEXT if allowed else None, show_alert=allowed)
+    elif isinstance(event, Message) and allowed:
+        markup = None
+        command, _, payload = (event.text or "").partition(" ")
+        if command == "/start" and payload:
+            # Кнопка повторяет ту же реферальную ссылку, чтобы приглашение не потерялось
+            me = await event.bot.me()
+            markup = retry_start_keyboard(f"https://t.me/{me.username}?start={payload}")
+        await event.answer(SHED_TEXT, reply_markup=markup)
+
+
+class SchedulingMiddleware(BaseMiddleware):
+    """Ставит хендлер в очередь своего класса; класс — флаг priority хендлера или класс роутера."""
+
+    def __init__(self, priority: str):
+        self.priority = priority
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id == ADMIN_ID:
+            priority = ADMIN
+        else:
+            priority = get_flag(data, "priority", default=self.priority)
+        if not await scheduler.acquire(priority):
+            await shed(event)
+            return
+        # Чтения и записи хендлера встают в очереди к БД в том же порядке классов
+        try:
+            with db.prioritized(CLASSES.index(priority)):
+                return await handler(event, data)
+        finally:
+            scheduler.release(priority)
+
+
+def setup(routers: dict):
+    """routers: {роутер: класс по умолчанию для его хендлеров}."""
+    for router, priority in routers.items():
+        middleware = SchedulingMiddleware(priority)
+        router.message.middleware(middleware)
+        router.callback_query.middleware(middleware)
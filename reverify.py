@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import random
+import time
+
+from aiogram import Bot
+
+import database as db
+import metrics
+import utils
+from config import REF_REWARD
+from notifier import notifier
+
+# Фоновая проверка берёт из общего бюджета Bot API не больше этого
+REVERIFY_RATE = 5
+REVERIFY_CONCURRENCY = 4
+REVERIFY_BATCH = 200
+# Свежие бонусы проверяются чаще (фермеры отписываются сразу), любой — не реже раза в сутки
+REVERIFY_MIN_INTERVAL = 3600
+REVERIFY_MAX_INTERVAL = 86400
+# Проверить не удалось (ошибка API) — повтор через полчаса, деньги не трогаем
+REVERIFY_RETRY = 1800
+REVERIFY_IDLE = 60
+# Пока интерактивные проверки ждут в общем лимитере дольше этого, фон не отправляет запросы
+INTERACTIVE_BACKLOG = 0.5
+
+
+def next_check(now: float, rewarded_at: float, amount: int) -> float:
+    """Следующая проверка: интервал растёт с возрастом бонуса и короче для бонусов крупнее обычного."""
+    interval = min(max(now - rewarded_at, REVERIFY_MIN_INTERVAL), REVERIFY_MAX_INTERVAL)
+    interval = max(interval * min(1.0, REF_REWARD * db.KOPECKS / max(amount, 1)), REVERIFY_MIN_INTERVAL)
+    # Разброс ±10%, чтобы проверки одного часа не сбивались в одну пачку
+    return now + interval * random.uniform(0.9, 1.1)
+
+
+class Reverifier:
+    """Перепроверка подписок приглашённых, за которых уже выплачен бонус.
+
+    Очередь — таблица reverify, порядок задаёт due_at, так что прогресс переживает перезапуск.
+    Запросы идут через свой лимитер поверх общего и ждут, пока разойдётся очередь
+    интерактивных проверок. Отписавшийся приглашённый — бонусы за него отзываются.
+    """
+
+    def __init__(self, rate: float = REVERIFY_RATE):
+        self.limiter = utils.RateLimiter(rate, REVERIFY_CONCURRENCY)
+        self._task = None
+
+    def start(self, bot: Bot):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(bot))
+
+    async def stop(self):
+        # Недоделанная пачка просто останется в очереди: ни отзыв, ни перенос не выполняются наполовину
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self, bot: Bot):
+        while True:
+            try:
+                checked = await self.run_batch(bot)
+            except Exception:
+                logging.exception("Subscription re-verification failed")
+                checked = 0
+            if not checked:
+                await asyncio.sleep(REVERIFY_IDLE)
+
+    async def _check(self, bot: Bot, user_id: int, channels):
+        while utils.api_limiter.backlog() > INTERACTIVE_BACKLOG:
+            await asyncio.sleep(INTERACTIVE_BACKLOG)
+        return await utils.verify_membership(user_id, bot, channels, self.limiter)
+
+    async def run_batch(self, bot: Bot) -> int:
+        """Проверяет очередную пачку; возвращает, сколько приглашённых обработано."""
+        settings = await db.get_settings()
+        if not settings["enabled"] or not settings["channels"]:
+            return 0
+        now = time.time()
+        rows = await db.get_reverify_due(now, REVERIFY_BATCH)
+        if not rows:
+            return 0
+        checks, dropped = [], []
+        for user_id, channels, amount, rewarded_at, _ in rows:
+            # Проверяем только каналы, которые требовались при начислении и требуются сейчас
+            channels = [channel for channel in channels.split() if channel in settings["channels"]]
+            if channels:
+                checks.append((user_id, amount, rewarded_at, channels))
+            else:
+                dropped.append(user_id)
+        results = await asyncio.gather(*(self._check(bot, user_id, channels) for user_id, _, _, channels in checks))
+        due, left = [], []
+        for (user_id, amount, rewarded_at, _), subscribed in zip(checks, results):
+            metrics.registry.inc("reverify_total", result={True: "member", False: "left", None: "error"}[subscribed])
+            if subscribed is None:
+                due.append((user_id, now + REVERIFY_RETRY))
+            elif subscribed:
+                due.append((user_id, next_check(now, rewarded_at, amount)))
+            else:
+                left.append(user_id)
+        await db.reschedule_reverify(due, dropped)
+        for user_id in left:
+            for referrer_id, amount, level in await db.claw_back_referral(user_id):
+                who = "приглашённый вами пользователь" if level == 1 else "пользователь из вашей команды"
+                notifier.send(referrer_id, f"➖ {utils.format_rub(amount)} ₽ списано: {who} отписался от канала, "
+                                           f"бонус за него отменён.")
+        return len(rows)
+
+
+reverifier = Reverifier()
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import multiprocessing as mp
+import queue
+import signal
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Update
+
+import database as db
+import fraud
+import metrics
+import priority
+import utils
+from bot import create_dispatcher
+from backup import backups
+from broadcast import broadcaster
+from config import ADMIN_ID, BOT_TOKEN, BOT_MODE, WORKERS, WORKER_QUEUE_SIZE, WORKER_CONCURRENCY, \
+    METRICS_HOST, METRICS_PORT
+from notifier import notifier
+from reverify import reverifier
+from webhook import WebhookHandler, run_webhook
+
+POLLING_TIMEOUT = 30
+DEPTH_REPORT_INTERVAL = 30
+STOP_TIMEOUT = 30
+
+
+def shard_key(update: dict) -> int:
+    """id пользователя (или чата), от которого пришло обновление; 0 — если его нет."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"]
+            chat = value.get("chat")
+            if chat:
+                return chat["id"]
+    return 0
+
+
+class Supervisor:
+    """Получает обновления один раз и раздаёт их воркерам: один пользователь — один воркер.
+
+    Обновления админа идут воркеру админа отдельной очередью, в обход очереди его шарда.
+    """
+
+    def __init__(self, workers: int = WORKERS, queue_size: int = WORKER_QUEUE_SIZE):
+        self.queues = [mp.Queue(queue_size) for _ in range(workers)]
+        self.admin_queue = mp.Queue()
+        self.processes = []
+
+    def start(self):
+        for index, updates in enumerate(self.queues):
+            admin_updates = self.admin_queue if ADMIN_ID % len(self.queues) == index else None
+            process = mp.Process(target=worker_main, args=(index, len(self.queues), updates, admin_updates),
+                                 name=f"bot-worker-{index}", daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def stop(self):
+        self.admin_queue.put(None)
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    def depths(self) -> list:
+        try:
+            return [updates.qsize() for updates in self.queues]
+        except NotImplementedError:  # macOS
+            return []
+
+    async def dispatch(self, update: dict):
+        if priority.from_admin(update):
+            self.admin_queue.put_nowait(update)
+            return
+        updates = self.queues[shard_key(update) % len(self.queues)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            # Воркер не успевает: ждём места и тем самым притормаживаем приём обновлений
+            await asyncio.get_running_loop().run_in_executor(None, updates.put, update)
+
+    async def report_depths(self):
+        while True:
+            await asyncio.sleep(DEPTH_REPORT_INTERVAL)
+            logging.info("Worker queue depths: %s", self.depths())
+
+    async def poll(self, bot: Bot, allowed_updates):
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                allowed_updates=allowed_updates,
+                                                request_timeout=POLLING_TIMEOUT + 10)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception:
+                logging.exception("getUpdates failed")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.dispatch(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+                offset = update.update_id + 1
+
+
+class ShardingWebhookHandler(WebhookHandler):
+    def __init__(self, bot: Bot, dp, supervisor: Supervisor):
+        super().__init__(bot, dp)
+        self.supervisor = supervisor
+
+    async def process(self, data: dict):
+        await self.supervisor.dispatch(data)
+
+
+async def run_supervisor():
+    # Воркеры форкаются до сборки диспетчера: роутеры — модульные синглтоны, и подключённые
+    # в родителе роутеры (с их middleware) потомок уже не смог бы подключить к своему диспетчеру
+    supervisor = Supervisor()
+    supervisor.start()
+    bot = Bot(token=BOT_TOKEN)
+    # Диспетчер здесь нужен только для списка типов обновлений и webhook-сервера
+    dp = create_dispatcher()
+    metrics.registry.collect("worker_queue_depth", lambda: sum(supervisor.depths()))
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    reporter = asyncio.create_task(supervisor.report_depths())
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp, ShardingWebhookHandler(bot, dp, supervisor))
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await supervisor.poll(bot, dp.resolve_used_update_types())
+    finally:
+        reporter.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        supervisor.stop()
+
+
+def worker_main(index: int, total: int, updates, admin_updates=None):
+    # Останавливает воркер супервизор (через None в очереди), а не Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(index, total, updates, admin_updates))
+
+
+async def _handle(bot: Bot, dp, data: dict, previous):
+    # Обновления одного пользователя идут строго по очереди; сколько хендлеров выполняется
+    # одновременно и в каком порядке, решает priority.scheduler внутри диспетчера
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dp.feed_update(bot, Update.model_validate(data, context={"bot": bot}))
+    except Exception:
+        logging.exception("Failed to process update %s", data.get("update_id"))
+
+
+async def _read(updates, spawn):
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, updates.get)
+        if data is None:
+            return
+        spawn(data)
+
+
+async def _worker(index: int, total: int, updates, admin_updates=None):
+    bot = Bot(token=BOT_TOKEN)
+    metrics.instrument_bot(bot)
+    dp = create_dispatcher()
+    # Лимиты Telegram общие на бота — делим их между воркерами
+    notifier.limiter.rate /= total
+    utils.api_limiter.rate /= total
+    fraud.detector.shard(total)
+    priority.scheduler.resize(WORKER_CONCURRENCY)
+    db.share_user_changes = True
+    await db.init_db()
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT and METRICS_PORT + 1 + index)
+    await notifier.start(bot)
+    # Рассылкой, копиями базы и перепроверкой подписок управляет воркер, которому достаются обновления админа
+    if ADMIN_ID % total == index:
+        await broadcaster.resume(bot)
+        backups.start()
+        reverifier.start(bot)
+    syncer = asyncio.create_task(db.sync_shared())
+
+    loop = asyncio.get_running_loop()
+    # Сколько обновлений воркер держит в памяти; остальные ждут в очереди супервизора
+    admitted = asyncio.Semaphore(WORKER_CONCURRENCY * 4)
+    chains = {}
+
+    def finished(task, key, admit):
+        if admit:
+            admitted.release()
+        if chains.get(key) is task:
+            del chains[key]
+
+    def spawn(data: dict, admit: bool = True):
+        key = shard_key(data)
+        task = asyncio.create_task(_handle(bot, dp, data, chains.get(key)))
+        chains[key] = task
+        task.add_done_callback(lambda t, key=key: finished(t, key, admit))
+
+    # Обновления админа не занимают места в admitted и не ждут очереди шарда
+    admin_reader = asyncio.create_task(_read(admin_updates, lambda data: spawn(data, False))) \
+        if admin_updates is not None else None
+    logging.info("Worker %d started", index)
+    try:
+        while True:
+            await admitted.acquire()
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            spawn(data)
+        if admin_reader is not None:
+            await admin_reader
+        if chains:
+            await asyncio.wait(list(chains.values()))
+    finally:
+        syncer.cancel()
+        await broadcaster.stop()
+        await backups.stop()
+        await reverifier.stop()
+        await notifier.stop()
+        await db.close_db()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        logging.info("Worker %d stopped", index)
@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery
+
+import database as db
+import metrics
+import utils
+from config import ADMIN_ID
+
+# Лимиты по умолчанию: не больше N нажатий за M секунд; админка может переопределить любой
+DEFAULT_LIMITS = {
+    "start": (3, 10.0),
+    "profile": (5, 10.0),
+    "check_sub": (3, 10.0),
+    "referrals": (5, 10.0),
+    "default": (10, 10.0),
+}
+MAX_BUCKETS = 100_000
+# Сколько самых старых корзин проверять на простой при каждом обращении
+EVICT_BATCH = 4
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+
+class Throttler:
+    """Токен-бакеты (user_id, действие) в ограниченном LRU; простаивающие корзины выселяются."""
+
+    def __init__(self, size: int = MAX_BUCKETS):
+        self.size = size
+        self._buckets = OrderedDict()
+        self._limits = (None, DEFAULT_LIMITS)  # (версия настроек, разобранные лимиты)
+        self.idle = max(period for _, period in DEFAULT_LIMITS.values())
+
+    def limits(self, settings) -> dict:
+        version, limits = self._limits
+        if version != settings["version"]:
+            try:
+                limits = {**DEFAULT_LIMITS, **utils.parse_limits(settings["throttle"])}
+            except ValueError:
+                limits = DEFAULT_LIMITS
+            self._limits = (settings["version"], limits)
+            self.idle = max(period for _, period in limits.values())
+        return limits
+
+    def _evict(self, now: float):
+        # Корзина, которая простояла дольше полного восстановления, ничем не отличается от новой
+        for _ in range(EVICT_BATCH):
+            if not self._buckets:
+                return
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < self.idle and len(self._buckets) <= self.size:
+                return
+            del self._buckets[key]
+
+    def hit(self, user_id: int, action: str, burst: int, period: float):
+        """True — пропустить; False — лишнее нажатие; None — лишнее и о нём уже предупредили."""
+        now = time.monotonic()
+        key = (user_id, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * burst / period)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        self._evict(now)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return True
+        if bucket.warned:
+            return None
+        bucket.warned = True
+        return False
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+throttler = Throttler()
+metrics.registry.collect("throttle_buckets", lambda: len(throttler))
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отсекает флуд до хендлера: лишние обновления молча отбрасываются,
+    только на первое лишнее нажатие кнопки отвечаем подсказкой."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        action = get_flag(data, "throttle", default="default")
+        limits = throttler.limits(await db.get_settings())
+        burst, period = limits.get(action, limits["default"])
+        allowed = throttler.hit(user.id, action, burst, period)
+        if allowed:
+            return await handler(event, data)
+        metrics.registry.inc("throttled_total", action=action)
+        if allowed is False and isinstance(event, CallbackQuery):
+            await event.answer("⏳ Слишком часто, подождите немного.")
+
+
+def setup(*routers):
+    middleware = ThrottlingMiddleware()
+    for router in routers:
+        router.message.middleware(middleware)
+        router.callback_query.middleware(middleware)
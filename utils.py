@@ -1,11 +1,260 @@
+import asyncio
+import contextlib
+import re
+import time
+from collections import OrderedDict
+
 from aiogram import Bot
-from aiogram.types import ChatMember
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramRetryAfter
 
-async def check_subscription(user_id: int, bot: Bot, channel: str) -> bool:
-    if not channel:
-        return True  # если канал не указан, считаем подписку выполненной
+import metrics
+
+MEMBERSHIP_CACHE_SIZE = 100_000
+MEMBERSHIP_POSITIVE_TTL = 600
+MEMBERSHIP_NEGATIVE_TTL = 15
+
+# Бюджет запросов к Bot API на проверки подписок
+API_CONCURRENCY = 20
+API_RATE = 25
+
+NOT_MEMBER = (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED)
+
+
+class RateLimiter:
+    """Ограничивает число одновременных запросов и их частоту (запросов в секунду)."""
+
+    def __init__(self, rate: float, concurrency: int):
+        self.rate = rate
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        # После 429 никто не отправляет запросы, пока не истечёт retry_after
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _wait_turn(self):
+        now = time.monotonic()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def acquire(self):
+        await self._semaphore.acquire()
+        try:
+            await self._wait_turn()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self):
+        self._semaphore.release()
+
+    def backlog(self) -> float:
+        """Сколько секунд уже расписано вперёд: больше нуля — запросы стоят в очереди."""
+        return max(0.0, max(self._next_slot, self._paused_until) - time.monotonic())
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class MembershipCache:
+    """LRU-кэш подписок (user_id, chat_id) -> bool с разным TTL для «да» и «нет»."""
+
+    def __init__(self, size: int = MEMBERSHIP_CACHE_SIZE,
+                 positive_ttl: float = MEMBERSHIP_POSITIVE_TTL,
+                 negative_ttl: float = MEMBERSHIP_NEGATIVE_TTL):
+        self.size = size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+
+    def get(self, user_id: int, chat_id: int):
+        key = (user_id, chat_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.registry.inc("membership_cache_total", result="miss")
+            return None
+        expires_at, is_member = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            metrics.registry.inc("membership_cache_total", result="miss")
+            return None
+        metrics.registry.inc("membership_cache_total", result="hit")
+        self._entries.move_to_end(key)
+        return is_member
+
+    def set(self, user_id: int, chat_id: int, is_member: bool):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (user_id, chat_id)
+        self._entries[key] = (time.monotonic() + ttl, is_member)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+membership = MembershipCache()
+metrics.registry.collect("membership_cache_entries", lambda: len(membership._entries))
+api_limiter = RateLimiter(API_RATE, API_CONCURRENCY)
+# username канала -> числовой chat_id, резолвится один раз
+_chat_ids = {}
+
+
+def is_member_status(status) -> bool:
+    return status not in NOT_MEMBER
+
+
+def is_tracked_chat(chat_id: int) -> bool:
+    return chat_id in _chat_ids.values()
+
+
+def parse_channels(text: str) -> list:
+    """Разбирает список каналов из строки: «@a, b https://t.me/c» -> ['a', 'b', 'c']."""
+    channels = []
+    for item in re.split(r"[\s,]+", text or ""):
+        item = item.replace("https://", "").replace("t.me/", "").strip("@/")
+        if item and item not in channels:
+            channels.append(item)
+    return channels
+
+
+def format_rub(kopecks: int) -> str:
+    """1250 -> '12.50', 1200 -> '12'."""
+    if kopecks % 100 == 0:
+        return str(kopecks // 100)
+    sign = "-" if kopecks < 0 else ""
+    return f"{sign}{abs(kopecks) // 100}.{abs(kopecks) % 100:02d}"
+
+
+def parse_limits(text: str) -> dict:
+    """«profile=5/10 check_sub=3/10» -> {'profile': (5, 10.0), ...}: не больше N нажатий за M секунд."""
+    limits = {}
+    for item in re.split(r"[\s,]+", text or ""):
+        if not item:
+            continue
+        action, _, value = item.partition("=")
+        burst, _, period = value.partition("/")
+        burst, period = int(burst), float(period)
+        if not action or burst < 1 or period <= 0:
+            raise ValueError(f"Invalid limit: {item}")
+        limits[action] = (burst, period)
+    return limits
+
+
+async def call_api(method, retries: int = 3, **kwargs):
+    """Вызывает метод Bot API в рамках общего бюджета, дожидаясь retry_after при 429."""
+    for attempt in range(retries + 1):
+        waited = time.perf_counter()
+        async with api_limiter:
+            # Ожидание слота лимитера, в том числе пауза после 429
+            metrics.registry.observe("api_limiter_wait_seconds", time.perf_counter() - waited)
+            try:
+                return await method(**kwargs)
+            except TelegramRetryAfter as e:
+                api_limiter.pause(e.retry_after)
+                if attempt == retries:
+                    raise
+
+
+async def resolve_channel(bot: Bot, channel) -> int:
+    if isinstance(channel, int):
+        return channel
+    chat_id = _chat_ids.get(channel)
+    if chat_id is None:
+        chat = await call_api(bot.get_chat, chat_id=f"@{channel}")
+        chat_id = _chat_ids[channel] = chat.id
+    return chat_id
+
+
+def _cached_membership(user_id: int, channel):
+    chat_id = channel if isinstance(channel, int) else _chat_ids.get(channel)
+    if chat_id is None:
+        return None
+    return membership.get(user_id, chat_id)
+
+
+async def _is_member(user_id: int, bot: Bot, channel, fresh: bool = False) -> bool:
     try:
-        member = await bot.get_chat_member(chat_id=f"@{channel}", user_id=user_id)
-        return member.status not in [ChatMember.LEFT, ChatMember.KICKED]
+        chat_id = await resolve_channel(bot, channel)
+        cached = membership.get(user_id, chat_id)
+        if cached or (cached is not None and not fresh):
+            return cached
+        member = await call_api(bot.get_chat_member, chat_id=chat_id, user_id=user_id)
+    except asyncio.CancelledError:
+        raise
     except Exception:
         return False
+    is_member = is_member_status(member.status)
+    membership.set(user_id, chat_id, is_member)
+    return is_member
+
+
+async def missing_channels(user_id: int, bot: Bot, channels, fresh: bool = False) -> list:
+    """Возвращает каналы, на которые пользователь не подписан.
+
+    Каналы проверяются параллельно; после первого отказа остальные проверки
+    отменяются, и непроверенные каналы тоже попадают в результат.
+    fresh — пользователь сам нажал «Проверить подписку»: закэшированным «нет» не верим,
+    он мог подписаться только что.
+    """
+    unknown = []
+    missing = set()
+    for channel in channels:
+        cached = _cached_membership(user_id, channel)
+        if cached is None or (fresh and not cached):
+            unknown.append(channel)
+        elif not cached:
+            missing.add(channel)
+    if missing:
+        missing.update(unknown)
+    elif unknown:
+        tasks = {asyncio.ensure_future(_is_member(user_id, bot, ch, fresh)): ch for ch in unknown}
+        pending = set(tasks)
+        try:
+            while pending and not missing:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                missing.update(tasks[task] for task in done if not task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+        missing.update(tasks[task] for task in pending)
+    return [ch for ch in channels if ch in missing]
+
+
+async def verify_membership(user_id: int, bot: Bot, channels, limiter: RateLimiter = None):
+    """Подписан ли пользователь на все каналы: True/False, None — проверить не удалось.
+
+    В отличие от missing_channels ошибка API здесь не считается отпиской: по результату
+    отзываются деньги. limiter — дополнительный бюджет фоновой проверки поверх общего.
+    """
+    for channel in channels:
+        cached = _cached_membership(user_id, channel)
+        if cached is None:
+            try:
+                chat_id = await resolve_channel(bot, channel)
+                async with limiter or contextlib.nullcontext():
+                    member = await call_api(bot.get_chat_member, chat_id=chat_id, user_id=user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                return None
+            cached = is_member_status(member.status)
+            membership.set(user_id, chat_id, cached)
+        if not cached:
+            return False
+    return True
+
+
+async def check_subscription(user_id: int, bot: Bot, channel: str) -> bool:
+    if not channel:
+        return True  # если канал не указан, считаем подписку выполненной
+    return not await missing_channels(user_id, bot, parse_channels(channel))
@@ -0,0 +1,97 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import priority
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_CONCURRENCY
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """Принимает обновления по HTTP, отвечает 200 и обрабатывает их в фоне.
+
+    Сколько хендлеров выполняется одновременно и в каком порядке, решает priority.scheduler.
+    Здесь только предел приёма: каждое принятое обновление до планировщика успевает прочитать
+    состояние FSM, и без предела волна /start копила бы задачи и чтения БД без ограничений.
+    Обновления админа идут в обход предела.
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, secret: str = WEBHOOK_SECRET,
+                 concurrency: int = WEBHOOK_CONCURRENCY):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self._intake = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or "update_id" not in data:
+            logging.warning("Malformed update received on webhook")
+            return web.Response(status=400)
+        bounded = not priority.from_admin(data)
+        if bounded:
+            # Пока не ответили, Telegram не шлёт новых обновлений по этому соединению
+            await self._intake.acquire()
+        task = asyncio.create_task(self.process(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if bounded:
+            task.add_done_callback(lambda _: self._intake.release())
+        return web.Response()
+
+    async def process(self, data: dict):
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logging.exception("Failed to process update %s", data.get("update_id"))
+
+    async def wait_idle(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_app(bot: Bot, dp: Dispatcher, handler: WebhookHandler = None) -> web.Application:
+    handler = handler or WebhookHandler(bot, dp)
+    app = web.Application()
+    app["webhook"] = handler
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, handler: WebhookHandler = None):
+    app = create_app(bot, dp, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logging.info("Webhook server listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    # Без WEBHOOK_URL сервер работает локально: обновления можно слать POST-запросами
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+    await dp.emit_startup(bot=bot)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await runner.cleanup()
+        await app["webhook"].wait_idle()